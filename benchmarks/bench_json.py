@@ -0,0 +1,65 @@
+"""
+Measures encoding and decoding Tastypie list payloads with each of the JSON
+backends that are installed.
+
+    python benchmarks/bench_json.py
+"""
+import datetime
+import decimal
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.core.exceptions import ImproperlyConfigured  # noqa
+
+from curling import lib  # noqa
+
+BACKENDS = ['json', 'simplejson', 'ujson']
+SIZES = [10, 1000, 10000]
+
+
+def payload(size):
+    """A Tastypie list of `size` objects, like a list of transactions."""
+    return {
+        'meta': {'limit': size, 'offset': 0, 'next': None,
+                 'previous': None, 'total_count': size},
+        'objects': [{
+            'amount': decimal.Decimal('%s.99' % pk),
+            'created': datetime.datetime(2013, 1, 2, 3, 4, 5),
+            'currency': 'USD',
+            'id': pk,
+            'notes': u'Transaction number %s \u2603' % pk,
+            'resource_uri': '/generic/transaction/%s/' % pk,
+            'success': pk % 2 == 0,
+        } for pk in range(size)]
+    }
+
+
+def run(sizes=SIZES):
+    results = []
+    for size in sizes:
+        data = payload(size)
+        content = json.dumps(data, cls=lib.Encoder)
+        number = max(1, 10000 / size)
+        for backend in BACKENDS:
+            try:
+                serializer = lib.JsonSerializer(backend=backend)
+            except ImproperlyConfigured:
+                continue
+            for name, func, arg in [('dumps', serializer.dumps, data),
+                                    ('loads', serializer.loads, content)]:
+                best = min(timeit.repeat(lambda: func(arg), number=number,
+                                         repeat=3))
+                results.append({'backend': backend, 'operation': name,
+                                'objects': size,
+                                'msec': best / number * 1000})
+    return results
+
+
+if __name__ == '__main__':
+    for result in run():
+        print '%(backend)-10s %(operation)s %(objects)6d objects: ' \
+            '%(msec)9.3f msec' % result
@@ -0,0 +1,257 @@
+"""
+Measures the overhead curling adds to a request: requests per second through
+a mock transport and against a local stub server, building resources,
+signing with OAuth, encoding and formatting lists, and the memory used to
+decode a large list.
+
+    python benchmarks/bench_pipeline.py
+"""
+import BaseHTTPServer
+import datetime
+import decimal
+import json
+import os
+import resource
+import SocketServer
+import sys
+import threading
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa
+
+from curling import lib, transport  # noqa
+
+SIZES = [10, 1000, 100000]
+
+
+def payload(size):
+    """A Tastypie list of `size` objects."""
+    return {
+        'meta': {'limit': size, 'offset': 0, 'next': None,
+                 'previous': None, 'total_count': size},
+        'objects': [{'id': pk, 'key': 'KEY_%s' % pk,
+                     'resource_uri': '/services/settings/%s/' % pk,
+                     'value': 'value %s' % pk} for pk in range(size)]
+    }
+
+
+def response(content, status_code=200):
+    resp = requests.models.Response()
+    resp._content = content
+    resp.status_code = status_code
+    resp.headers['content-type'] = 'application/json'
+    resp.headers['content-length'] = str(len(content))
+    return resp
+
+
+class MockResource(lib.TastypieResource):
+    """Returns the same response to every request, without any network."""
+    content = json.dumps({'id': 1, 'key': 'KEY', 'value': 'value'})
+
+    def __init__(self, *args, **kw):
+        super(MockResource, self).__init__(*args, **kw)
+        self._resource = MockResource
+
+    def _call_request(self, method, url, data, params, headers, **kw):
+        return response(self.content)
+
+
+class MockAPI(lib.API):
+
+    def __init__(self, *args, **kw):
+        super(MockAPI, self).__init__(*args, **kw)
+        self._resource = MockResource
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep the connections open, like most servers curling talks to.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    content = MockResource.content
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.content)))
+        self.end_headers()
+        self.wfile.write(self.content)
+
+    def log_message(self, *args):
+        pass
+
+
+def stub_server():
+    """Starts a server on a free local port, returns its URL."""
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%s' % server.server_address[1]
+
+
+def usec(func, number):
+    """The best time of a call to func, in microseconds."""
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+def peak_memory(func):
+    """
+    The peak memory of a process running func, in the units of ru_maxrss:
+    kilobytes on Linux and bytes on OS X. Runs in a child process so each
+    measurement starts from the same baseline.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        func()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        os.write(write, str(usage.ru_maxrss))
+        os._exit(0)
+    os.close(write)
+    peak = int(os.read(read, 64))
+    os.close(read)
+    os.waitpid(pid, 0)
+    return peak
+
+
+def result(name, value, unit, **extra):
+    extra.update({'name': name, 'value': value, 'unit': unit})
+    return extra
+
+
+def bench_requests(number):
+    api = MockAPI('http://foo.com')
+    signed = MockAPI('http://foo.com')
+    signed.activate_oauth('key', 'secret')
+    data = {'key': 'KEY', 'value': 'value'}
+    return [
+        result('mock_get', 1e6 / usec(api.services.settings(1).get, number),
+               'requests/sec'),
+        result('mock_post', 1e6 / usec(
+            lambda: api.services.settings.post(data), number),
+            'requests/sec'),
+        result('mock_get_oauth', 1e6 / usec(
+            signed.services.settings(1).get, number), 'requests/sec'),
+    ]
+
+
+def wsgi_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [MockResource.content]
+
+
+def bench_server(number):
+    server, url = stub_server()
+    results = []
+    try:
+        for name, sender in [
+                ('server_get', None),
+                ('server_get_urllib3', transport.Urllib3Transport())]:
+            api = lib.API(url, transport=sender)
+            results.append(result(name, 1e6 / usec(
+                api.services.settings(1).get, number), 'requests/sec'))
+            (sender or api._store['session']).close()
+        api = lib.API(url, transport=transport.WSGITransport(wsgi_app))
+        results.append(result('wsgi_get', 1e6 / usec(
+            api.services.settings(1).get, number), 'requests/sec'))
+        return results
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_attributes(number):
+    api = MockAPI('http://foo.com')
+    return [
+        result('attribute_chain',
+               usec(lambda: api.services.settings, number), 'usec'),
+        result('attribute_chain_id',
+               usec(lambda: api.services.settings(1), number), 'usec'),
+        result('by_url',
+               usec(lambda: api.by_url('/services/settings/1/'), number),
+               'usec'),
+    ]
+
+
+def bench_sign(number):
+    extra = {'key': 'key', 'secret': 'secret', 'realm': ''}
+
+    def sign():
+        lib.sign_request(None, extra=extra, headers={}, method='GET',
+                         params={}, url='http://foo.com/services/settings/')
+
+    return [result('oauth_sign', usec(sign, number), 'usec')]
+
+
+def bench_encoder(number):
+    serializer = lib.JsonSerializer()
+    data = {'amount': decimal.Decimal('10.99'),
+            'created': datetime.datetime(2013, 1, 2, 3, 4, 5),
+            'date': datetime.date(2013, 1, 2),
+            'time': datetime.time(3, 4, 5)}
+    return [result('encoder_dumps', usec(lambda: serializer.dumps(data),
+                                         number), 'usec')]
+
+
+def bench_lists(sizes):
+    api = MockAPI('http://foo.com')
+    results = []
+    for size in sizes:
+        data = payload(size)
+        resp = response(json.dumps(data))
+        number = max(1, 10000 / size)
+        res = api.services.settings
+        results.append(result(
+            'format_list', usec(lambda: res._format_list(data), number) /
+            1000, 'msec', objects=size))
+        results.append(result(
+            'decode_list', usec(
+                lambda: res._try_to_serialize_response(resp), number) /
+            1000, 'msec', objects=size))
+    return results
+
+
+def bench_memory(size):
+    content = json.dumps(payload(size))
+    results = []
+    for lazy in (False, True):
+        api = MockAPI('http://foo.com', lazy_lists=lazy)
+        resp = response(content)
+        res = api.services.settings
+
+        def decode():
+            objects = res._try_to_serialize_response(resp)
+            objects[0]
+
+        results.append(result('decode_list_peak', peak_memory(decode),
+                              'ru_maxrss', objects=size, lazy=lazy))
+    results.append(result('baseline_peak', peak_memory(lambda: None),
+                          'ru_maxrss'))
+    return results
+
+
+def run(number=2000, sizes=SIZES):
+    # Fork for the memory measurements before the server starts a thread.
+    results = bench_memory(sizes[-1])
+    results.extend(bench_requests(number))
+    results.extend(bench_server(number / 4))
+    results.extend(bench_attributes(number * 10))
+    results.extend(bench_sign(number))
+    results.extend(bench_encoder(number * 10))
+    results.extend(bench_lists(sizes))
+    return results
+
+
+if __name__ == '__main__':
+    for res in run():
+        extra = ', '.join('%s=%s' % (k, v) for k, v in sorted(res.items())
+                          if k not in ('name', 'value', 'unit'))
+        print '%-20s %12.2f %-12s %s' % (res['name'], res['value'],
+                                         res['unit'], extra)
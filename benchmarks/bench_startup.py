@@ -0,0 +1,57 @@
+"""
+Measures how long the curling command takes to start, each in a new Python
+process: importing the command, importing curling.lib, and running
+`curling --help`.
+
+    python benchmarks/bench_startup.py
+"""
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each prints the milliseconds it took, from inside the process.
+SCRIPTS = {
+    'import_command': 'import curling.command',
+    'import_lib': 'import curling.lib',
+    'show_raw': 'from curling import command; command.show({}, raw=True)',
+    'show_highlighted': 'from curling import command; command.show({})',
+}
+TIMED = ('import sys, time; sys.path.insert(0, %r); start = time.time()\n'
+         '%s\n'
+         'sys.stderr.write("%%f" %% ((time.time() - start) * 1000))')
+
+HELP = ('import sys; sys.path.insert(0, %r); sys.argv = ["curling", "--help"]'
+        '\nfrom curling.command import main; main()')
+
+
+def child(script):
+    """Runs script in a new interpreter, returns what it wrote to stderr."""
+    proc = subprocess.Popen([sys.executable, '-c', script],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return err
+
+
+def run(repeat=10):
+    results = []
+    for name, script in sorted(SCRIPTS.items()):
+        best = min(float(child(TIMED % (ROOT, script)))
+                   for i in range(repeat))
+        results.append({'name': name, 'value': best, 'unit': 'msec'})
+
+    # The whole process, including starting Python.
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        child(HELP % ROOT)
+        timings.append((time.time() - start) * 1000)
+    results.append({'name': 'help', 'value': min(timings), 'unit': 'msec'})
+    return results
+
+
+if __name__ == '__main__':
+    for result in run():
+        print '%(name)-18s %(value)8.1f %(unit)s' % result
@@ -0,0 +1,49 @@
+"""
+Runs every benchmark in this directory and prints the results as JSON, so
+they can be stored and compared between releases:
+
+    python benchmarks/run.py > results.json
+    python benchmarks/run.py bench_pipeline
+
+Each module named bench_*.py is run through its run() function.
+"""
+import datetime
+import glob
+import json
+import os
+import platform
+import re
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+
+def modules(names=None):
+    found = sorted(os.path.basename(p)[:-3]
+                   for p in glob.glob(os.path.join(HERE, 'bench_*.py')))
+    return [name for name in found if not names or name in names]
+
+
+def version():
+    with open(os.path.join(os.path.dirname(HERE), 'setup.py')) as setup:
+        match = re.search(r"version='([^']+)'", setup.read())
+    return match.group(1) if match else None
+
+
+def run(names=None):
+    results = {}
+    for name in modules(names):
+        print >> sys.stderr, 'Running %s...' % name
+        results[name] = __import__(name).run()
+    return {
+        'curling': version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    print json.dumps(run(sys.argv[1:]), indent=2, sort_keys=True)
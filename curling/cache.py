@@ -0,0 +1,83 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    """
+    A thread safe in-process cache that evicts the least recently used
+    entries once there are more than `max_entries`, and entries older than
+    `timeout` seconds. A timeout of None means entries never expire.
+    """
+
+    def __init__(self, max_entries=1000, timeout=300):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            # Put it back at the end, as the most recently used.
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        expires = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DjangoCache(object):
+    """
+    Uses one of the caches configured in Django, by default the `default`
+    one, to store the entries. Eviction is up to that cache.
+    """
+
+    def __init__(self, alias='default', timeout=300, prefix='curling'):
+        self.alias = alias
+        self.timeout = timeout
+        self.prefix = prefix
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def _key(self, key):
+        # Keep keys short and safe for backends like memcached.
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return '%s:%s' % (self.prefix, hashlib.md5(key).hexdigest())
+
+    def get(self, key, default=None):
+        return self.cache.get(self._key(key), default)
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        self.cache.set(self._key(key), value, timeout)
+
+    def delete(self, key):
+        self.cache.delete(self._key(key))
@@ -1,26 +1,19 @@
 import argparse
-import httplib
+import itertools
 import json
-import mimetypes
 import os
 import sys
-import tempfile
+import threading
 import urlparse
-import webbrowser
 from collections import OrderedDict
 
-from pygments import highlight
-try:
-    from pygments.lexers import JSONLexer as lexer
-except ImportError:
-    from pygments.lexers import JsonLexer as lexer
+# The rest is imported when it's used, so that the command starts quickly:
+# pygments only to highlight, requests only for --legacy, curling.lib and
+# what it imports (Django, slumber, requests) only for a request.
 
-from pygments.formatters import Terminal256Formatter
 
-import requests
-from slumber.exceptions import HttpClientError
-
-import lib
+# How many requests of a batch, per thread, are read at a time.
+BATCH_SLICE = 16
 
 
 def get_config():
@@ -38,8 +31,18 @@ def get_domain(domain):
 
 def show(data, raw=False):
     res = json.dumps(data, indent=2)
-    print res if raw else highlight(res, lexer(),
-                                    Terminal256Formatter(bg='dark'))
+    if raw:
+        print res
+        return
+
+    from pygments import highlight
+    from pygments.formatters import Terminal256Formatter
+    try:
+        from pygments.lexers import JSONLexer as lexer
+    except ImportError:
+        from pygments.lexers import JsonLexer as lexer
+
+    print highlight(res, lexer(), Terminal256Formatter(bg='dark'))
 
 
 def show_text(data, content_type='text/plain'):
@@ -49,19 +52,47 @@ def show_text(data, content_type='text/plain'):
             return
 
     if data:
+        import mimetypes
+        import tempfile
+        import webbrowser
+
         ext = mimetypes.guess_extension(content_type)
         desc, name = tempfile.mkstemp(suffix=ext)
         open(name, 'w').write(data)
         webbrowser.open('file://%s' % name)
 
 
+def stdin_body():
+    """
+    Stdin as the body of a request. A redirected file is passed as it is,
+    so that it is sent with a Content-Length, which servers like runserver
+    need. Anything else, like a pipe, is read in chunks and sent chunked.
+    """
+    import stat
+
+    import lib
+
+    try:
+        if stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode):
+            return sys.stdin
+    except (AttributeError, OSError, ValueError):
+        # Like a StringIO, which has no file descriptor.
+        pass
+    return lib.iter_chunks(sys.stdin)
+
+
 def new(config, lib_api=None):
+    import lib
+    from slumber.exceptions import HttpClientError
+
     url = urlparse.urlparse(config.url)
     api = lib_api or lib.API('{0}://{1}'.format(url.scheme, url.netloc))
     binary_data = False
     headers = {}
+    upload = None
 
     if config.include:
+        import httplib
         httplib.HTTPConnection.debuglevel = 1
 
     local = get_domain(url.netloc)
@@ -85,8 +116,11 @@ def new(config, lib_api=None):
         if config.data:
             print '--data and --data-binary are mutually exclusive.'
             return
+        # Read files as they are sent, rather than all at once.
         if config.data_binary == '@-':
-            config.data = ''.join(sys.stdin.readlines())
+            config.data = stdin_body()
+        elif config.data_binary.startswith('@'):
+            config.data = upload = open(config.data_binary[1:], 'rb')
         else:
             config.data = config.data_binary
         headers['content-disposition'] = (
@@ -109,6 +143,9 @@ def new(config, lib_api=None):
         }
         show(res, config.raw)
         sys.exit(1)
+    finally:
+        if upload is not None:
+            upload.close()
 
     if isinstance(res, (dict, list)):
         show(res, config.raw)
@@ -117,7 +154,139 @@ def new(config, lib_api=None):
     return res
 
 
+class APIs(object):
+    """
+    One API for each host, shared by the threads of a batch so that they
+    share its connections, signed with OAuth if the config has credentials
+    for the host.
+    """
+
+    def __init__(self, concurrency, lib_api=None):
+        self.concurrency = concurrency
+        self.lib_api = lib_api
+        self._apis = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        import lib
+
+        if self.lib_api is not None:
+            return self.lib_api
+        host = '{0}://{1}'.format(url.scheme, url.netloc)
+        with self._lock:
+            if host not in self._apis:
+                api = lib.API(host, pool_maxsize=self.concurrency)
+                local = get_domain(url.netloc)
+                if local:
+                    api.activate_oauth(local['key'], local['secret'],
+                                       realm=local.get('realm', ''))
+                self._apis[host] = api
+            return self._apis[host]
+
+
+def _text(body):
+    """A response body that isn't decoded, as text that JSON can encode."""
+    import requests
+
+    if isinstance(body, requests.Response):
+        return body.text
+    if isinstance(body, str):
+        return body.decode('utf-8', 'replace')
+    return body
+
+
+def batch_request(apis, number, line):
+    """
+    Sends the request described by a line of a batch, a JSON object with
+    the method, url, and optionally the data and headers. Returns whether it
+    succeeded and the result line: the line number, method, url and either
+    the body of the response, or the status and body of the error.
+    """
+    from slumber.exceptions import SlumberHttpBaseException
+
+    import lib
+
+    result = {'line': number}
+    try:
+        spec = json.loads(line)
+        method = spec.get('method', 'GET').upper()
+        result.update({'method': method, 'url': spec['url']})
+        url = urlparse.urlparse(spec['url'])
+        api = apis.get(url)
+        for path in url.path.split('/'):
+            api = getattr(api, path)
+        query_dict = OrderedDict(urlparse.parse_qsl(str(url.query)))
+        if method == 'DELETE':
+            res = api.delete(**query_dict)
+        else:
+            res = getattr(api, method.lower())(
+                spec.get('data'), headers=spec.get('headers'), **query_dict)
+        if isinstance(res, dict) and 'meta' in res:
+            res['meta']['headers'] = dict(res['meta']['headers'])
+        result.update({'ok': True, 'body': _text(res)})
+    except SlumberHttpBaseException, err:
+        response = getattr(err, 'response', None)
+        result.update({
+            'ok': False,
+            'status': getattr(response, 'status_code', None),
+            'body': _text(getattr(err, 'content', None)),
+        })
+        if response is None:
+            # Like connection errors or timeouts.
+            result['error'] = _text(err.args[0] if err.args else str(err))
+    except Exception, err:
+        result.update({'ok': False, 'error': _text('%s: %s' % (
+            err.__class__.__name__, err))})
+    try:
+        return result['ok'], json.dumps(result, cls=lib.Encoder)
+    except (TypeError, ValueError):
+        # A body JSON can't encode, like a 304 response.
+        result['body'] = repr(result.get('body'))
+        return result['ok'], json.dumps(result, cls=lib.Encoder)
+
+
+def batch(config, lib_api=None, output=None):
+    """
+    Sends the requests read as JSON lines from config.batch, a file name or
+    - for stdin, config.concurrency at a time. Writes one JSON result per
+    line to output, in the order of the input or, with config.unordered, as
+    they complete. Returns the number of requests that failed.
+
+    The input is read a slice at a time, so that the memory used doesn't
+    grow with the number of requests.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    output = output or sys.stdout
+    source = sys.stdin if config.batch == '-' else open(config.batch, 'r')
+    concurrency = max(1, config.concurrency)
+    apis = APIs(concurrency, lib_api=lib_api)
+    lines = ((number, line) for number, line in enumerate(source, 1)
+             if line.strip())
+    pool = ThreadPool(concurrency)
+    imap = pool.imap_unordered if config.unordered else pool.imap
+    failed = 0
+    try:
+        while True:
+            # The pool reads all of what it is given straight away.
+            chunk = list(itertools.islice(lines, concurrency * BATCH_SLICE))
+            if not chunk:
+                break
+            for ok, result in imap(lambda args: batch_request(apis, *args),
+                                   chunk):
+                failed += not ok
+                output.write(result + '\n')
+                output.flush()
+    finally:
+        pool.terminate()
+        if source is not sys.stdin:
+            source.close()
+    return failed
+
+
 def old(config):
+    import requests
+
     headers = {'Accept': 'application/json',
                'Content-Type': 'application/json'}
     try:
@@ -149,9 +318,20 @@ def main():
     parser.add_argument('-l', '--legacy', action='store_true', required=False)
     parser.add_argument('-r', '--raw', action='store_true', required=False,
                         help='Print raw output with no highlighting')
-    parser.add_argument('url')
+    parser.add_argument('--batch', default=None, required=False,
+                        help='Send the requests read as JSON lines from a '
+                             'file, or - for stdin')
+    parser.add_argument('--concurrency', default=8, type=int, required=False,
+                        help='How many requests of a batch to send at once')
+    parser.add_argument('--unordered', action='store_true', required=False,
+                        help='Print the results of a batch as they complete')
+    parser.add_argument('url', nargs='?')
 
     config = parser.parse_args()
+    if config.batch:
+        sys.exit(1 if batch(config) else 0)
+    if not config.url:
+        parser.error('a url is required, unless using --batch')
     if config.legacy:
         old(config)
     else:
@@ -19,3 +19,7 @@ class Encoder(json.JSONEncoder):
 
     def default(self, v):
         return self.ENCODINGS.get(type(v), super(Encoder, self).default)(v)
+
+
+# For JSON libraries that take a default function rather than an encoder.
+default = Encoder().default
@@ -1,29 +1,80 @@
+import datetime
 import json
+import random
+import re
+import sys
+import threading
+import time
 import urllib
 import urlparse
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings  # noqa
 from django.core.exceptions import (ImproperlyConfigured,
                                     MultipleObjectsReturned,
                                     ObjectDoesNotExist)
 
-import oauthlib.oauth1
+
+class _NullStatsd(object):
+    """Drops the stats, when django_statsd isn't available or configured."""
+
+    def incr(self, *args, **kw):
+        pass
+
+    decr = gauge = timing = incr
+
+    @contextmanager
+    def timer(self, *args, **kw):
+        yield
+
 
 try:
     from django_statsd.clients import statsd
 except (ImportError, ImproperlyConfigured):
-    from mock import MagicMock
-    statsd = MagicMock()
+    statsd = _NullStatsd()
 
-from requests.exceptions import ConnectionError
+from requests.adapters import (DEFAULT_POOLBLOCK, DEFAULT_POOLSIZE,
+                               DEFAULT_RETRIES, HTTPAdapter)
+from requests.exceptions import ConnectionError, Timeout
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
 
 from slumber import exceptions
 from slumber import API as SlumberAPI, Resource, url_join
 from slumber import serialize
 
+from cache import LocalCache
+import encoder
 from encoder import Encoder
 
 
+# OAuth clients don't change when signing, so they are shared between
+# requests and threads, keyed on their credentials.
+_oauth_clients = LocalCache(max_entries=1000, timeout=None)
+
+
+def _oauth_client(key, secret, resource_owner_key=None, callback_uri=None,
+                  verifier=None):
+    # A verifier is only used once, to get an access token, so its clients
+    # aren't kept.
+    cache_key = (key, secret, resource_owner_key, callback_uri)
+    client = None if verifier else _oauth_clients.get(cache_key)
+    if client is None:
+        # Imported here as it is slow to import and only needed for OAuth.
+        import oauthlib.oauth1
+        client = oauthlib.oauth1.Client(
+            key, client_secret=secret,
+            resource_owner_key=resource_owner_key,
+            callback_uri=callback_uri, verifier=verifier)
+        if not verifier:
+            _oauth_clients.set(cache_key, client)
+    return client
+
+
 def sign_request(slumber, extra=None, headers=None, method=None, params=None,
                  url=None, **kwargs):
     if headers is None:
@@ -33,10 +84,8 @@ def sign_request(slumber, extra=None, headers=None, method=None, params=None,
     verifier = params.pop('oauth_verifier', None)
     if params:
         url = '%s?%s' % (url, urllib.urlencode(params))
-    client = oauthlib.oauth1.Client(
-        extra['key'], client_secret=extra['secret'],
-        resource_owner_key=resource_owner_key,
-        callback_uri=callback_uri, verifier=verifier)
+    client = _oauth_client(extra['key'], extra['secret'], resource_owner_key,
+                           callback_uri, verifier)
     uri, signed_headers, body = client.sign(
         url, http_method=method, headers=headers, realm=extra.get('realm', ''))
 
@@ -79,6 +128,10 @@ class TastypieAttributesMixin(object):
         if item.startswith('_'):
             raise AttributeError(item)
 
+        return self._cached_resource(('attr', item), self._new_resource,
+                                     item)
+
+    def _new_resource(self, item):
         kwargs = {}
         for key, value in self._store.iteritems():
             kwargs[key] = value
@@ -87,18 +140,194 @@ class TastypieAttributesMixin(object):
 
         return self._resource(**kwargs)
 
+    def _cached_resource(self, key, factory, *args):
+        """
+        Resources are shared through the cache in the API's store, if there
+        is one, so that walking the same path again doesn't copy the store
+        and join the URL again. Don't change the store of a cached resource.
+        """
+        resources = self._store.get('resources')
+        if resources is None:
+            return factory(*args)
+
+        key = (self._resource, self._store['base_url']) + key
+        resource = resources.get(key)
+        if resource is None:
+            resource = factory(*args)
+            resources.set(key, resource)
+        return resource
+
 
 class TastypieList(list):
     pass
 
 
+def _cached_response(status_code, headers, content):
+    """Makes a Response again from what the response cache keeps of it."""
+    resp = Response()
+    resp.status_code = status_code
+    resp.headers = CaseInsensitiveDict(headers)
+    resp._content = content
+    return resp
+
+
+# Tastypie sorts the keys of its responses, so a list starts with its meta.
+_meta_start = re.compile(r'\s*\{\s*"meta"\s*:\s*')
+_objects_start = re.compile(r'\s*,\s*"objects"\s*:\s*\[')
+_decoder = json.JSONDecoder()
+
+
+def _split_meta(content):
+    """
+    Decodes only the meta of a Tastypie list response. Returns None if the
+    content doesn't start with the meta followed by the objects.
+    """
+    if not content:
+        return
+    start = _meta_start.match(content)
+    if not start:
+        return
+    try:
+        meta, end = _decoder.raw_decode(content, start.end())
+    except ValueError:
+        return
+    if isinstance(meta, dict) and _objects_start.match(content, end):
+        return meta
+
+
+def _loads_first(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kw):
+        # Like objects == other, where list reads the storage of both.
+        for arg in (self,) + args:
+            if isinstance(arg, LazyTastypieList):
+                arg.load()
+        return method(self, *args, **kw)
+    wrapper.__name__ = name
+    return wrapper
+
+
+class LazyTastypieList(TastypieList):
+    """
+    A TastypieList that keeps the response content and only decodes the
+    objects the first time the list is used. The meta is available straight
+    away.
+
+    Code that reads the storage of the list directly, rather than through
+    its methods, will see an empty list until it has been loaded: calling
+    the methods of list on it, like list.__len__(objects), or C extensions
+    using the list API. Call load first in those cases.
+    """
+
+    def __init__(self, loads, content):
+        super(LazyTastypieList, self).__init__()
+        self._loads = loads
+        self._content = content
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Decodes the objects, if that hasn't been done yet."""
+        if self._content is None:
+            return self
+        with self._lock:
+            if self._content is not None:
+                list.extend(self, self._loads(self._content)['objects'])
+                self._content = None
+        return self
+
+    def __radd__(self, other):
+        # [0] + objects would otherwise read the storage of the list.
+        if not isinstance(other, list):
+            return NotImplemented
+        for arg in (other, self):
+            if isinstance(arg, LazyTastypieList):
+                arg.load()
+        return list.__add__(other, self)
+
+    def __reduce__(self):
+        # Pickle and copy as a plain TastypieList, without the lock.
+        attrs = dict((k, v) for k, v in self.__dict__.items()
+                     if not k.startswith('_'))
+        return TastypieList, (list(self),), attrs
+
+    def __reduce_ex__(self, protocol):
+        return self.__reduce__()
+
+
+for name in ['__add__', '__contains__', '__delitem__', '__delslice__',
+             '__eq__', '__ge__', '__getitem__', '__getslice__', '__gt__',
+             '__iadd__', '__imul__', '__iter__', '__le__', '__len__', '__lt__',
+             '__mul__', '__ne__', '__repr__', '__reversed__', '__rmul__',
+             '__setitem__', '__setslice__', 'append', 'count', 'extend',
+             'index', 'insert', 'pop', 'remove', 'reverse', 'sort']:
+    setattr(LazyTastypieList, name, _loads_first(name))
+
+
+def _json_backend(name):
+    """
+    Returns the dumps and loads functions for a JSON backend:
+
+    * json: the standard library.
+    * simplejson: simplejson, which is usually faster for both.
+    * ujson: ujson for loads only, as it can't use our Encoder for dumps.
+    * auto: simplejson if it is installed, otherwise json.
+    """
+    json_dumps = partial(json.dumps, cls=Encoder)
+    if name == 'auto':
+        try:
+            import simplejson  # noqa
+            name = 'simplejson'
+        except ImportError:
+            name = 'json'
+
+    try:
+        if name == 'json':
+            return json_dumps, json.loads
+        elif name == 'simplejson':
+            import simplejson
+            # use_decimal=False so decimals are encoded as strings by the
+            # Encoder, namedtuple_as_object=False so namedtuples are encoded
+            # as lists and allow_nan=True so NaN is encoded, like the
+            # standard library.
+            dumps = partial(simplejson.dumps, default=encoder.default,
+                            use_decimal=False, namedtuple_as_object=False,
+                            tuple_as_array=True, allow_nan=True)
+            try:
+                decoder = simplejson.JSONDecoder(allow_nan=True)
+            except TypeError:
+                # Versions before 3.19 always decode NaN.
+                decoder = simplejson.JSONDecoder()
+
+            def loads(data):
+                # Decoding a str gives str for ASCII strings, the standard
+                # library always gives unicode.
+                if isinstance(data, str):
+                    data = data.decode('utf-8')
+                return decoder.decode(data)
+            return dumps, loads
+        elif name == 'ujson':
+            import ujson
+            return json_dumps, ujson.loads
+    except ImportError:
+        raise ImproperlyConfigured('JSON backend %s is not installed' % name)
+    raise ImproperlyConfigured('Unknown JSON backend: %s' % name)
+
+
 # Serialize using our encoding.
 class JsonSerializer(serialize.JsonSerializer):
 
     key = 'json'
 
+    def __init__(self, backend='json'):
+        self.backend = backend
+        self._dumps, self._loads = _json_backend(backend)
+
     def dumps(self, data):
-        return json.dumps(data, cls=Encoder)
+        return self._dumps(data)
+
+    def loads(self, data):
+        return self._loads(data)
 
 
 def default_parser(url):
@@ -123,18 +352,570 @@ def safe_parser(url):
     return tuple(u for u in url.split('/') if u), None
 
 
-def _key(url, method):
-    """Produce a standard key for clients like statsd."""
-    return '%s.%s' % (
-        '.'.join([u for u in urlparse.urlparse(url).path.split('/') if u]),
-        method)
+# The statuses of a set/1;2;3/ request that mean the resource doesn't
+# support them, so get_many gets the objects one at a time instead.
+SET_UNSUPPORTED = (400, 404, 405)
+
+
+def _imap_batches(func, items, concurrency):
+    """
+    Calls func on each item over a pool of `concurrency` threads, one batch
+    of `concurrency` items at a time, yielding the results in order.
+    """
+    items = list(items)
+    if not items:
+        return
+    pool = ThreadPool(max(1, min(concurrency, len(items))))
+    try:
+        for start in range(0, len(items), concurrency):
+            for result in pool.map(func, items[start:start + concurrency]):
+                yield result
+    finally:
+        pool.terminate()
+
+
+# The size of the chunks read from files and responses when streaming.
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_chunks(fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Reads fileobj a chunk at a time, for sending a file that doesn't have a
+    known length, like stdin, as a chunked upload.
+    """
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _rewinder(data):
+    """
+    Returns a function that makes the body data ready to be sent again, or
+    None if it can only be sent once, like an iterator or a pipe.
+    """
+    if data is None or isinstance(data, basestring):
+        return lambda: None
+    try:
+        position = data.tell()
+    except (AttributeError, IOError):
+        return None
+    return partial(data.seek, position)
+
+
+# The encodings responses can use, when the API compresses.
+ACCEPT_ENCODING = 'gzip, deflate'
+
+
+def _compress(data, encoding):
+    """Compresses data for the Content-Encoding gzip or deflate."""
+    # zlib writes gzip with 16 added to wbits, deflate is the zlib format.
+    wbits = zlib.MAX_WBITS | 16 if encoding == 'gzip' else zlib.MAX_WBITS
+    compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _setting(name, default):
+    """Returns the Django setting CURLING_<NAME>, if Django is configured."""
+    if not settings.configured:
+        return default
+    return getattr(settings, 'CURLING_%s' % name.upper(), default)
+
+
+def _stat_name(name):
+    """Makes a host usable as a part of a statsd key."""
+    return name.replace('.', '_').replace(':', '_')
+
+
+def _pool_usage(pool):
+    """The size and usage of a urllib3 connection pool."""
+    # The queue holds the idle connections and a placeholder for each
+    # connection that can still be opened.
+    maxsize = pool.pool.maxsize if pool.pool else 0
+    idle = pool.pool.qsize() if pool.pool else 0
+    return {'maxsize': maxsize, 'in_use': maxsize - idle,
+            'connections': pool.num_connections}
+
+
+def _query_params(url):
+    """
+    The query string params of a URL, with the values of keys that are
+    repeated, like order_by, kept as a list.
+    """
+    query = urlparse.urlparse(url).query
+    params = urlparse.parse_qs(query, keep_blank_values=True)
+    return dict((k, v[0] if len(v) == 1 else v) for k, v in params.items())
+
+
+def _is_conditional(headers):
+    """True if the headers already make the request a conditional one."""
+    conditional = set(['if-none-match', 'if-modified-since'])
+    return any(k.lower() in conditional for k in (headers or {}))
+
+
+# Path segments that look like primary keys: numbers, lists of numbers
+# like 1;2;3, UUIDs and long hex digests.
+_pk_segment = re.compile(r'^(\d+(;\d+)*|[0-9a-f]{8}(-?[0-9a-f]{4}){3}-?'
+                         r'[0-9a-f]{12}|[0-9a-f]{32,})$', re.I)
+
+
+def raw_key_parser(path):
+    """
+    Splits the path of a URL into the parts of a statsd key, as is. Each
+    primary key gets its own statsd keys.
+    """
+    return [u for u in path.split('/') if u]
+
+
+def key_parser(path):
+    """
+    Splits the path of a URL into the parts of a statsd key, replacing the
+    parts that look like a primary key with `pk`, so that
+    /services/settings/8/ gives services.settings.pk.
+    """
+    return ['pk' if u.isdigit() or _pk_segment.match(u) else u
+            for u in path.split('/') if u]
+
+
+def _url_path(url):
+    """
+    The path of a URL. Quicker than urlparse, whose own cache only holds a
+    few URLs.
+    """
+    path = url.partition('?')[0].partition('#')[0]
+    _, netloc, rest = path.partition('://')
+    if netloc:
+        path = '/' + rest.partition('/')[2]
+    return path
+
+
+class StatsKey(object):
+    """
+    Produces the key of a request for clients like statsd, from its URL and
+    method, using `parser` to turn the path of the URL into the parts of the
+    key.
+
+    Any callable taking the URL and method can be passed to the API as
+    stats_key instead.
+    """
+
+    def __init__(self, parser=key_parser):
+        self.parser = parser
+
+    def __call__(self, url, method):
+        return '%s.%s' % ('.'.join(self.parser(_url_path(url))), method)
+
+
+_key = StatsKey()
+
+
+class RetryPolicy(object):
+    """
+    When and how often TastypieResource retries a request that failed with
+    a connection error or one of the `statuses`.
+
+    * max_attempts: the number of attempts, including the first one.
+    * backoff: the seconds to wait before the first retry, doubled for each
+      following retry, up to max_backoff.
+    * jitter: if True, wait a random time between none and the backoff, so
+      that clients don't all retry at the same time.
+    * statuses: the HTTP statuses to retry.
+    * methods: the HTTP methods to retry, by default only idempotent ones.
+
+    If the response has a Retry-After header in seconds, we wait at least
+    that long, or give up if that is longer than max_backoff.
+    """
+
+    def __init__(self, max_attempts=3, backoff=0.1, max_backoff=5,
+                 jitter=True, statuses=(502, 503, 504),
+                 methods=('DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT')):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(m.upper() for m in methods)
+
+    def should_retry(self, method, resp):
+        """Retry connection errors, when resp is None, and the statuses."""
+        if method.upper() not in self.methods:
+            return False
+        return resp is None or resp.status_code in self.statuses
+
+    def delay(self, attempt, resp=None):
+        """
+        The seconds to wait after the attempt, starting at 1, or None if the
+        Retry-After of the response is too long to wait.
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        try:
+            retry_after = int(resp.headers.get('retry-after'))
+        except (AttributeError, TypeError, ValueError):
+            retry_after = None
+        if retry_after is not None:
+            if retry_after > self.max_backoff:
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+
+class HttpTimeoutError(exceptions.HttpServerError):
+    """Raised when a request times out or its deadline has passed."""
+
+
+class Deadline(object):
+    """
+    The time by which a logical operation, that can make several requests,
+    must be done. Requests made under a deadline have their timeout cut to
+    what remains, and raise HttpTimeoutError once it has passed.
+    """
+
+    def __init__(self, seconds):
+        self.expires = time.time() + seconds
+
+    @classmethod
+    def make(cls, deadline):
+        """Turns a number of seconds into a Deadline, passes others on."""
+        if deadline is None or isinstance(deadline, cls):
+            return deadline
+        return cls(deadline)
+
+    def remaining(self):
+        return max(0, self.expires - time.time())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class Instrument(object):
+    """
+    Receives the timings of the phases of each request. Subclass this and
+    pass instances to the API as `instruments` to send them to a tracing
+    system. The phases are:
+
+    * serialize: encoding the data sent, size is the length of the body.
+    * callbacks: running the callbacks, such as OAuth signing.
+    * send: connecting, sending the request and waiting for the first byte
+      of the response.
+    * download: reading the response body, size is its Content-Length.
+    * decode: decoding the response body, size is its length.
+    * format_list: turning a Tastypie list into a TastypieList, size is the
+      number of objects.
+    """
+
+    def phase(self, key, name, seconds, size=None):
+        """Called with the statsd key of the request, see StatsKey."""
+        raise NotImplementedError
+
+
+class StatsdInstrument(Instrument):
+    """Sends each phase as a statsd timing, and its size if there is one."""
+
+    def phase(self, key, name, seconds, size=None):
+        statsd.timing('%s.%s' % (key, name), seconds * 1000)
+        if size is not None:
+            statsd.timing('%s.%s.size' % (key, name), size)
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Makes sure only one call for each key runs at a time: callers that
+    arrive while a call with the same key is in flight wait for it and get
+    its result, or its exception, rather than making their own call.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, deadline=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            timeout = deadline.remaining() if deadline else None
+            if not call.done.wait(timeout):
+                raise HttpTimeoutError('Deadline exceeded waiting for: %s'
+                                       % (key,), response=None, content=None)
+            if call.error:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = func()
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class CircuitOpen(exceptions.HttpServerError):
+    """Raised, without making a request, when the circuit to a host is open."""
+
+
+class _Circuit(object):
+
+    def __init__(self, window):
+        self.state = CircuitBreaker.CLOSED
+        self.results = deque(maxlen=window)
+        self.opened = None
+        self.probes = 0
+        # Counts the times the circuit went half open, so that the result
+        # of a probe from an earlier time can be told apart.
+        self.generation = 0
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to a host that keeps failing.
+
+    The outcome of the last `window` requests to each host is kept. Once
+    there have been at least `min_requests` and `failure_rate` of them failed,
+    with a connection error or a 5xx, the circuit is open and requests fail
+    straight away with CircuitOpen. After `reset_timeout` seconds the circuit
+    is half open and lets `probes` requests through: if they succeed it is
+    closed again, otherwise it opens again.
+
+    Circuits are keyed on the host, or on what `key` returns for a URL.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+    # The values of the statsd gauges for each state.
+    GAUGES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failure_rate=0.5, min_requests=10, window=20,
+                 reset_timeout=30, probes=1, key=None):
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.key = key or (lambda url: urlparse.urlparse(url).netloc)
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def _circuit(self, key):
+        if key not in self._circuits:
+            self._circuits[key] = _Circuit(self.window)
+        return self._circuits[key]
+
+    def _set_state(self, key, circuit, state):
+        circuit.state = state
+        statsd.gauge('curling.circuit.%s' % _stat_name(key),
+                     self.GAUGES[state])
+
+    def before(self, key):
+        """
+        Raises CircuitOpen if a request to key shouldn't be made. Returns a
+        token to pass to record with the outcome of the request, telling
+        whether it is a probe.
+        """
+        with self._lock:
+            circuit = self._circuit(key)
+            if (circuit.state == self.OPEN and
+                    time.time() - circuit.opened >= self.reset_timeout):
+                self._set_state(key, circuit, self.HALF_OPEN)
+                circuit.probes = 0
+                circuit.generation += 1
+            if circuit.state == self.HALF_OPEN:
+                if circuit.probes < self.probes:
+                    circuit.probes += 1
+                    return circuit.generation
+            if circuit.state != self.CLOSED:
+                raise CircuitOpen('Circuit open: %s' % key,
+                                  response=None, content=None)
+
+    def record(self, key, success, token=None):
+        """
+        Records the outcome of a request to key, with the token before
+        returned for it. While the circuit is half open only the outcome of
+        its probes count, not those of requests started before it opened.
+        """
+        with self._lock:
+            circuit = self._circuit(key)
+            if circuit.state == self.HALF_OPEN:
+                if token is None or token != circuit.generation:
+                    return
+                circuit.probes -= 1
+                if success:
+                    circuit.results.clear()
+                    self._set_state(key, circuit, self.CLOSED)
+                else:
+                    self._open(key, circuit)
+                return
+
+            circuit.results.append(success)
+            failures = circuit.results.count(False)
+            if (circuit.state == self.CLOSED and
+                    len(circuit.results) >= self.min_requests and
+                    failures >= self.failure_rate * len(circuit.results)):
+                self._open(key, circuit)
+
+    def _open(self, key, circuit):
+        circuit.opened = time.time()
+        self._set_state(key, circuit, self.OPEN)
+
+    def state(self, key):
+        """The state of the circuit to key: closed, half_open or open."""
+        with self._lock:
+            circuit = self._circuits.get(key)
+            return circuit.state if circuit else self.CLOSED
+
+    def status(self):
+        """
+        The state of every circuit, as a dict of key to its state and the
+        number of recent requests and failures.
+        """
+        with self._lock:
+            return dict((key, {'state': c.state,
+                               'requests': len(c.results),
+                               'failures': c.results.count(False)})
+                        for key, c in self._circuits.items())
+
+
+class Projection(object):
+    """
+    Keeps only the `fields` of objects, or removes the `exclude` ones. For
+    Tastypie lists this applies to each object, the meta is left alone.
+    """
+
+    def __init__(self, fields=None, exclude=None):
+        self.fields = tuple(sorted(fields)) if fields else None
+        self.exclude = tuple(sorted(exclude or ()))
+
+    def params(self, fields_name, exclude_name):
+        """The query parameters asking the server for the projection."""
+        params = {}
+        if self.fields:
+            params[fields_name] = ','.join(self.fields)
+        if self.exclude:
+            params[exclude_name] = ','.join(self.exclude)
+        return params
+
+    def __call__(self, obj):
+        if not isinstance(obj, dict):
+            return obj
+        if self.fields:
+            # A new dict only holds the fields kept.
+            obj = dict((k, obj[k]) for k in self.fields if k in obj)
+        for k in self.exclude:
+            obj.pop(k, None)
+        return obj
+
+    def response(self, resp):
+        """Applies to a decoded response, a Tastypie list or an object."""
+        if isinstance(resp, dict) and isinstance(resp.get('objects'), list):
+            resp['objects'] = [self(obj) for obj in resp['objects']]
+            return resp
+        return self(resp)
+
+    def __repr__(self):
+        return 'Projection(%r, %r)' % (self.fields, self.exclude)
+
+
+class TastypieBulk(object):
+    """
+    Collects objects to create, update or delete on a Tastypie list and sends
+    them using PATCH on the list, with up to `chunk_size` changes in each
+    request. Created by TastypieResource.bulk.
+    """
+
+    def __init__(self, resource, chunk_size=100, headers=None):
+        self.resource = resource
+        self.chunk_size = chunk_size
+        self.headers = headers
+        self.pending = []
+        # The results of every chunk sent so far.
+        self.results = []
+
+    def create(self, obj):
+        self.pending.append(('objects', obj))
+
+    def update(self, obj):
+        """Updates an object, which must have a resource_uri."""
+        if not obj.get('resource_uri'):
+            raise ValueError('Cannot update an object without resource_uri')
+        self.pending.append(('objects', obj))
+
+    def delete(self, resource_uri):
+        self.pending.append(('deleted_objects', resource_uri))
+
+    def send(self, deadline=None):
+        """
+        Sends the pending changes and returns a list with the result of each
+        request: the number of objects and deleted_objects it contained and
+        either the response as `result` or the exception raised as `error`.
+        An error in one chunk does not stop the following ones.
+        """
+        deadline = Deadline.make(deadline)
+        pending, self.pending = self.pending, []
+        results = []
+        for start in range(0, len(pending), self.chunk_size):
+            data = {'objects': [], 'deleted_objects': []}
+            for kind, item in pending[start:start + self.chunk_size]:
+                data[kind].append(item)
+            result = {'objects': len(data['objects']),
+                      'deleted_objects': len(data['deleted_objects']),
+                      'result': None, 'error': None}
+            if not data['deleted_objects']:
+                del data['deleted_objects']
+            try:
+                result['result'] = self.resource.patch(
+                    data, headers=self.headers, deadline=deadline)
+            except (exceptions.HttpClientError,
+                    exceptions.HttpServerError), exc:
+                result['error'] = exc
+            results.append(result)
+        self.results.extend(results)
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.send()
 
 
 class TastypieResource(TastypieAttributesMixin, Resource):
+    format_lists = True
 
     def __init__(self, *args, **kw):
         super(TastypieResource, self).__init__(*args, **kw)
 
+    def __call__(self, id=None, format=None, url_override=None):
+        call = super(TastypieResource, self).__call__
+        if format is not None or url_override is not None:
+            resource = call(id=id, format=format, url_override=url_override)
+            # The store differs from the API's, so the resources under this
+            # one mustn't be shared with those of the API.
+            resource._store['resources'] = None
+            return resource
+        if id is None:
+            return self
+        return self._cached_resource(('call', id), call, id)
+
     def _is_list(self, resp):
         try:
             return set(['meta', 'objects']).issubset(set(resp.keys()))
@@ -147,7 +928,34 @@ class TastypieResource(TastypieAttributesMixin, Resource):
             setattr(tpl, k, v)
         return tpl
 
-    def _try_to_serialize_response(self, resp):
+    def _lazy_list(self, resp):
+        """
+        Returns a LazyTastypieList if the response is a JSON Tastypie list,
+        or None.
+        """
+        content_type = resp.headers.get('content-type', '')
+        try:
+            serializer = self._store['serializer'].get_serializer(
+                content_type=content_type.split(';')[0].strip())
+        except exceptions.SerializerNotAvailable:
+            return
+        if serializer.key != 'json':
+            return
+        meta = _split_meta(resp.content)
+        if meta is None:
+            return
+        meta[u'headers'] = resp.headers
+        loads = serializer.loads
+        projection = self._projection(resp)
+        if projection is not None:
+            loads = lambda content: projection.response(
+                serializer.loads(content))
+        tpl = LazyTastypieList(loads, resp.content)
+        for k, v in meta.iteritems():
+            setattr(tpl, k, v)
+        return tpl
+
+    def _try_to_serialize_response(self, resp, method='GET'):
         headers = resp.headers
         # 204 specifically does not return any data so we shouldn't try and
         # parse it.
@@ -158,24 +966,132 @@ class TastypieResource(TastypieAttributesMixin, Resource):
                     response=resp)
             return
 
-        resp = super(TastypieResource, self)._try_to_serialize_response(resp)
+        with self._phase(method, 'decode') as info:
+            info['size'] = len(resp.content or '')
+            lazy = None
+            if self.format_lists and self._store.get('lazy_lists'):
+                lazy = self._lazy_list(resp)
+            if lazy is None:
+                projection = self._projection(resp)
+                resp = super(TastypieResource,
+                             self)._try_to_serialize_response(resp)
+                if projection is not None:
+                    resp = projection.response(resp)
+        if lazy is not None:
+            return lazy
+
         if isinstance(resp, dict) and u'meta' in resp:
             resp[u'meta'][u'headers'] = headers
         if self.format_lists and self._is_list(resp):
-            return self._format_list(resp)
+            with self._phase(method, 'format_list') as info:
+                info['size'] = len(resp['objects'])
+                return self._format_list(resp)
+        return resp
+
+    def _projection(self, resp):
+        """The projection to apply to a successful response, if any."""
+        projection = self._store.get('projection')
+        if projection is not None and 200 <= resp.status_code <= 299:
+            return projection
+
+    def projection(self, fields=None, exclude=None):
+        """
+        Returns a copy of this resource whose responses only have the
+        `fields` of each object, or don't have the `exclude` ones, so that
+        wide objects take less memory.
+
+        If the API has projection_params, they are sent as query
+        parameters so the server can leave the fields out too.
+        """
+        kwargs = dict(self._store)
+        kwargs['projection'] = Projection(fields, exclude)
+        # Cached resources are shared with the resource without projection.
+        kwargs['resources'] = None
+        return self.__class__(**kwargs)
+
+    def _project_params(self, params):
+        """Adds the query parameters of the projection to params."""
+        projection = self._store.get('projection')
+        names = self._store.get('projection_params')
+        if projection is None or not names:
+            return params
+        params = dict(params)
+        params.update(projection.params(*names))
+        return params
+
+    def _cache_key(self, headers, params):
+        """
+        The key for a GET, made of the URL, the query string, the headers
+        and the callbacks, so that different OAuth credentials don't share
+        responses.
+        """
+        callbacks = [(c.get('extra'), c.get('params'))
+                     for c in self._store.get('callbacks', [])]
+        return repr((self._url(), sorted((params or {}).items()),
+                     sorted((headers or {}).items()), callbacks,
+                     self._store.get('projection')))
+
+    def _cached_get(self, cache, headers, params, deadline=None):
+        """
+        Does a GET using the response cache. If there's a cached response
+        the request is made conditional with its ETag and Last-Modified
+        headers and the cached response is returned on a 304.
+        """
+        key = self._cache_key(headers, params)
+        cached = cache.get(key)
+        hdrs = dict(headers or {})
+        if cached:
+            etag, modified = cached[:2]
+            if etag:
+                hdrs['If-None-Match'] = etag
+            if modified:
+                hdrs['If-Modified-Since'] = modified
+
+        resp = self._request('GET', headers=hdrs, params=params,
+                             deadline=deadline)
+        if resp.status_code == 304:
+            return _cached_response(*cached[2:]) if cached else resp
+        elif not 200 <= resp.status_code <= 299:
+            return resp
+
+        etag = resp.headers.get('etag')
+        modified = resp.headers.get('last-modified')
+        if etag or modified:
+            cache.set(key, (etag, modified, resp.status_code,
+                            dict(resp.headers), resp.content))
         return resp
 
-    def get(self, data=None, headers=None, **kwargs):
+    def _dumps(self, method, data, binary_data):
+        if binary_data:
+            return data
+        with self._phase(method, 'serialize') as info:
+            data = self._store['serializer'].dumps(data)
+            info['size'] = len(data)
+        return data
+
+    def get(self, data=None, headers=None, deadline=None, **kwargs):
         """
         Allow a body in GET, because that's just fine.
+
+        Like the other methods, this takes a deadline, in seconds or as a
+        Deadline, after which HttpTimeoutError is raised.
         """
         if data:
-            s = self._store['serializer']
-            data = data if kwargs.get('binary_data') else s.dumps(data)
+            data = self._dumps('GET', data, kwargs.get('binary_data'))
         else:
             data = None
-        resp = self._request('GET', data=data,
-                             headers=headers, params=kwargs)
+        kwargs = self._project_params(kwargs)
+        inflight = self._store.get('inflight')
+        if inflight is not None and data is None:
+            deadline = Deadline.make(deadline)
+            # Only the response is shared, each caller decodes its own
+            # result so that changing it doesn't change the others'.
+            resp = inflight.do(
+                self._cache_key(headers, kwargs),
+                partial(self._get, data, headers, deadline, kwargs),
+                deadline=deadline)
+        else:
+            resp = self._get(data, headers, deadline, kwargs)
         if 200 <= resp.status_code <= 299:
             return self._try_to_serialize_response(resp)
         elif resp.status_code == 304:
@@ -183,41 +1099,222 @@ class TastypieResource(TastypieAttributesMixin, Resource):
         else:
             return
 
-    def post(self, data, headers=None, **kwargs):
-        s = self._store['serializer']
-        data = data if kwargs.get('binary_data') else s.dumps(data)
-
-        resp = self._request('POST', data=data,
-                             headers=headers, params=kwargs)
+    def _get(self, data, headers, deadline, params):
+        """Does a GET, returning the response."""
+        cache = self._store.get('cache')
+        if (cache is not None and data is None and
+                not _is_conditional(headers)):
+            return self._cached_get(cache, headers, params, deadline=deadline)
+        return self._request('GET', data=data, headers=headers,
+                             params=params, deadline=deadline)
+
+    def post(self, data, headers=None, deadline=None, **kwargs):
+        data = self._dumps('POST', data, kwargs.get('binary_data'))
+
+        resp = self._request('POST', data=data, headers=headers,
+                             params=kwargs, deadline=deadline,
+                             compress=not kwargs.get('binary_data'))
         if 200 <= resp.status_code <= 299:
-            return self._try_to_serialize_response(resp)
+            return self._try_to_serialize_response(resp, method='POST')
         else:
             # @@@ Need to be Some sort of Error Here or Something
             return
 
-    def patch(self, data, headers=None, **kwargs):
-        s = self._store['serializer']
-        data = data if kwargs.get('binary_data') else s.dumps(data)
+    def patch(self, data, headers=None, deadline=None, **kwargs):
+        data = self._dumps('PATCH', data, kwargs.get('binary_data'))
 
-        resp = self._request('PATCH', data=data,
-                             headers=headers, params=kwargs)
+        resp = self._request('PATCH', data=data, headers=headers,
+                             params=kwargs, deadline=deadline,
+                             compress=not kwargs.get('binary_data'))
         if 200 <= resp.status_code <= 299:
-            return self._try_to_serialize_response(resp)
+            return self._try_to_serialize_response(resp, method='PATCH')
         else:
             # @@@ Need to be Some sort of Error Here or Something
             return
 
-    def put(self, data, headers=None, **kwargs):
-        s = self._store['serializer']
-        data = data if kwargs.get('binary_data') else s.dumps(data)
+    def put(self, data, headers=None, deadline=None, **kwargs):
+        data = self._dumps('PUT', data, kwargs.get('binary_data'))
 
-        resp = self._request('PUT', data=data,
-                             headers=headers, params=kwargs)
+        resp = self._request('PUT', data=data, headers=headers,
+                             params=kwargs, deadline=deadline,
+                             compress=not kwargs.get('binary_data'))
         if 200 <= resp.status_code <= 299:
-            return self._try_to_serialize_response(resp)
+            return self._try_to_serialize_response(resp, method='PUT')
         else:
             return False
 
+    def delete(self, deadline=None, **kwargs):
+        resp = self._request('DELETE', params=kwargs, deadline=deadline)
+        return 200 <= resp.status_code <= 299
+
+    def download(self, fileobj=None, chunk_size=CHUNK_SIZE, headers=None,
+                 deadline=None, **kwargs):
+        """
+        GETs the resource without holding the whole response in memory.
+
+        With a fileobj the response body is written to it, one chunk at a
+        time, and the number of bytes written returned. Otherwise this
+        returns an iterator over the chunks of the body, which holds a
+        connection until it is exhausted.
+
+        The deadline only covers getting the response, not reading it.
+        """
+        resp = self._request('GET', headers=headers, params=kwargs,
+                             deadline=deadline, stream=True)
+        chunks = resp.iter_content(chunk_size)
+        if fileobj is None:
+            return chunks
+        written = 0
+        for chunk in chunks:
+            fileobj.write(chunk)
+            written += len(chunk)
+        return written
+
+    def iter_pages(self, headers=None, deadline=None, **kw):
+        """
+        Iterates over the pages of a Tastypie list, one page at a time.
+
+        Each page is fetched only when the previous one has been consumed,
+        following the offset and limit given in meta.next until there are
+        no more pages. If the response is not a Tastypie list, it is returned
+        as a single page.
+        """
+        deadline = Deadline.make(deadline)
+        params = kw
+        while True:
+            self.format_lists = True
+            page = self.get(headers=headers, deadline=deadline, **params)
+            next_url = getattr(page, 'next', None)
+            yield page
+            # Drop our reference so the page can be garbage collected
+            # before the next one is fetched.
+            del page
+            if not next_url:
+                return
+            params = _query_params(next_url)
+
+    def iterate(self, headers=None, deadline=None, **kw):
+        """
+        Iterates over every object in a Tastypie list, fetching the pages
+        lazily. See iter_pages.
+        """
+        for page in self.iter_pages(headers=headers, deadline=deadline, **kw):
+            if not isinstance(page, list):
+                page = [page]
+            for obj in page:
+                yield obj
+            del page
+
+    def get_all(self, concurrency=8, headers=None, deadline=None, **kw):
+        """
+        Iterates over every object in a Tastypie list, like iterate, but once
+        the first page is known fetches the remaining pages concurrently.
+
+        The offsets of all the pages are computed from meta.total_count and
+        meta.limit and fetched in batches of `concurrency` requests that
+        share the session. Objects are still yielded in order.
+        """
+        deadline = Deadline.make(deadline)
+        self.format_lists = True
+        page = self.get(headers=headers, deadline=deadline, **kw)
+        if not isinstance(page, TastypieList):
+            for obj in (page if isinstance(page, list) else [page]):
+                yield obj
+            return
+
+        limit = getattr(page, 'limit', None)
+        total = getattr(page, 'total_count', None)
+        start = getattr(page, 'offset', None) or 0
+        for obj in page:
+            yield obj
+        del page
+        if not limit or total is None:
+            return
+
+        def fetch(offset):
+            params = kw.copy()
+            params.update({'offset': offset, 'limit': limit})
+            return self.get(headers=headers, deadline=deadline, **params)
+
+        offsets = range(start + limit, total, limit)
+        for page in _imap_batches(fetch, offsets, concurrency):
+            for obj in page:
+                yield obj
+            del page
+
+    def get_many(self, pks, concurrency=8, chunk_size=100, pk_field='id',
+                 headers=None, deadline=None, **kw):
+        """
+        Gets the objects with the primary keys `pks`, returning a dict of
+        each pk to its object, or to the exception getting it raised.
+        Objects that don't exist map to an ObjectDoesNotExist.
+
+        The objects are fetched with Tastypie's set/1;2;3/ URL, `chunk_size`
+        at a time, with up to `concurrency` requests at once. If the first
+        of those fails with a 400, 404 or 405, the resource is taken not to
+        support them and each object is fetched with its own request
+        instead. Any other client error of the first request, such as a 401
+        or 429, is raised. `pk_field` is the field of the objects that holds
+        their pk.
+        """
+        deadline = Deadline.make(deadline)
+        pks = list(OrderedDict.fromkeys(pks))
+        chunks = [pks[i:i + chunk_size]
+                  for i in range(0, len(pks), chunk_size)]
+        results = {}
+        if not chunks:
+            return results
+
+        def fetch_set(chunk):
+            ids = ';'.join(unicode(pk) for pk in chunk)
+            resource = self._new_resource('set/%s' % ids)
+            try:
+                return resource.get(headers=headers, deadline=deadline, **kw)
+            except (exceptions.HttpClientError,
+                    exceptions.HttpServerError), exc:
+                return exc
+
+        def fetch_one(pk):
+            try:
+                return self._new_resource(pk).get(
+                    headers=headers, deadline=deadline, **kw)
+            except exceptions.HttpClientError, exc:
+                if exc.response.status_code == 404:
+                    return ObjectDoesNotExist(pk)
+                return exc
+            except exceptions.HttpServerError, exc:
+                return exc
+
+        first = fetch_set(chunks[0])
+        if isinstance(first, exceptions.HttpClientError):
+            if first.response.status_code not in SET_UNSUPPORTED:
+                raise first
+            for pk, res in zip(pks, _imap_batches(fetch_one, pks,
+                                                  concurrency)):
+                results[pk] = res
+            return results
+
+        responses = [first]
+        responses.extend(_imap_batches(fetch_set, chunks[1:], concurrency))
+        for chunk, res in zip(chunks, responses):
+            if isinstance(res, Exception):
+                results.update((pk, res) for pk in chunk)
+                continue
+            found = dict((unicode(obj.get(pk_field)), obj)
+                         for obj in res.get('objects', []))
+            for pk in chunk:
+                obj = found.get(unicode(pk))
+                results[pk] = obj if obj is not None else (
+                    ObjectDoesNotExist(pk))
+        return results
+
+    def bulk(self, chunk_size=100, headers=None):
+        """
+        Returns a TastypieBulk to create, update and delete many objects of
+        this list in as few requests as possible.
+        """
+        return TastypieBulk(self, chunk_size=chunk_size, headers=headers)
+
     def get_object(self, **kw):
         """
         Gets an object and checks that one and only one object is returned.
@@ -265,57 +1362,231 @@ class TastypieResource(TastypieAttributesMixin, Resource):
             raise ObjectDoesNotExist
         return res
 
-    def _call_request(self, method, url, data, params, headers):
-        return self._store["session"].request(method, url, data=data,
-                                              params=params, headers=headers)
-
-    def _request(self, method, data=None, params=None, headers=None):
-        """
-        Overwrite so we can pass through custom headers, like oauth
-        or something useful.
-        """
-        s = self._store["serializer"]
+    def _url(self):
         url = self._store["base_url"]
-
         if self._store["append_slash"] and not url.endswith("/"):
             url = url + "/"
+        return url
+
+    def _call_request(self, method, url, data, params, headers, **kw):
+        sender = self._store.get('transport') or self._store['session']
+        return sender.request(method, url, data=data, params=params,
+                              headers=headers, **kw)
+
+    def _headers(self, method, url, data, params, headers):
+        s = self._store["serializer"]
         hdrs = {"accept": s.get_content_type(),
                 "content-type": s.get_content_type()}
+        if self._store.get('compress'):
+            hdrs['accept-encoding'] = ACCEPT_ENCODING
         hdrs.update(headers or {})
-        for callback in self._store.get('callbacks', []):
-            callback['method'](self, data=data, extra=callback.get('extra'),
-                               headers=hdrs, method=method,
-                               params=merge(params, callback.get('params')),
-                               url=url)
-
-        stats_key = _key(url, method)
-        with statsd.timer(stats_key):
+        callbacks = self._store.get('callbacks', [])
+        if not callbacks:
+            return hdrs
+        with self._phase(method, 'callbacks'):
+            for callback in callbacks:
+                callback['method'](self, data=data,
+                                   extra=callback.get('extra'),
+                                   headers=hdrs, method=method,
+                                   params=merge(params,
+                                                callback.get('params')),
+                                   url=url)
+        return hdrs
+
+    def _timeout(self, deadline):
+        """
+        The timeout for the next request: the API's timeout, shortened to
+        what is left before the deadline.
+        """
+        timeout = self._store.get('timeout')
+        if deadline is None:
+            return timeout
+        remaining = deadline.remaining()
+        if timeout is None:
+            return remaining
+        if isinstance(timeout, tuple):
+            return tuple(min(t, remaining) for t in timeout)
+        return min(timeout, remaining)
+
+    def _request(self, method, data=None, params=None, headers=None,
+                 deadline=None, stream=False, compress=False):
+        """
+        Overwrite so we can pass through custom headers, like oauth
+        or something useful.
+
+        Bodies that can only be read once, like iterators, are never
+        retried. With stream, the response body isn't read. With compress,
+        the body is compressed if the API compresses bodies.
+        """
+        url = self._url()
+        stats_key = self._stats_key(url, method)
+        encoding = self._store.get('compress')
+        if encoding and compress:
+            data, headers = self._compress(stats_key, encoding, data, headers)
+        retry = self._store.get('retry')
+        breaker = self._store.get('circuit_breaker')
+        circuit = breaker.key(url) if breaker else None
+        deadline = Deadline.make(deadline)
+        rewind = _rewinder(data) if retry else None
+        attempt = 0
+        while True:
+            attempt += 1
+            if deadline is not None and deadline.expired():
+                statsd.incr('%s.timeout' % stats_key)
+                raise HttpTimeoutError('Deadline exceeded: %s' % url,
+                                       response=None, content=None)
+
+            # The callbacks run again for each attempt, so that things like
+            # OAuth nonces aren't reused.
+            hdrs = self._headers(method, url, data, params, headers)
+            if breaker:
+                token = breaker.before(circuit)
+            kw = {'stream': True} if stream else {}
+            timeout = self._timeout(deadline)
+            if timeout is not None:
+                kw['timeout'] = timeout
+            success = timed_out = False
             try:
-                resp = self._call_request(method, url, data, params, hdrs)
-            except ConnectionError:
-                # In the case of connection errors, there isn't a response
-                # so let's explicitly set up to None.
-                raise exceptions.HttpServerError('Connection Error',
-                                                 response=None,
-                                                 content=None)
-
-        statsd.incr('%s.%s' % (stats_key, resp.status_code))
+                with statsd.timer(stats_key):
+                    start = time.time()
+                    try:
+                        resp = self._call_request(method, url, data, params,
+                                                  hdrs, **kw)
+                    except Timeout:
+                        resp, timed_out = None, True
+                    except ConnectionError:
+                        resp = None
+                success = resp is not None and resp.status_code < 500
+            finally:
+                if breaker:
+                    breaker.record(circuit, success, token)
+            if resp is not None and self._store.get('instruments'):
+                self._send_phases(method, resp, time.time() - start)
+
+            if resp is not None:
+                statsd.incr('%s.%s' % (stats_key, resp.status_code))
+            elif timed_out:
+                statsd.incr('%s.timeout' % stats_key)
+            if rewind is None or not retry.should_retry(method, resp):
+                break
+            delay = retry.delay(attempt, resp)
+            if (delay is None or attempt >= retry.max_attempts or
+                    (deadline is not None and delay >= deadline.remaining())):
+                statsd.incr('%s.giveup' % stats_key)
+                break
+            statsd.incr('%s.retry' % stats_key)
+            time.sleep(delay)
+            rewind()
+
+        if timed_out:
+            raise HttpTimeoutError('Timeout: %s' % url,
+                                   response=None, content=None)
+        if resp is None:
+            # In the case of connection errors, there isn't a response
+            # so let's explicitly set up to None.
+            raise exceptions.HttpServerError('Connection Error',
+                                             response=None,
+                                             content=None)
+
+        if self._store.get('pool_stats'):
+            self._pool_gauges(url)
+        if encoding and not stream:
+            self._response_sizes(stats_key, resp)
         if 400 <= resp.status_code <= 499:
             raise exceptions.HttpClientError(
                 "Client Error %s: %s" % (resp.status_code, url),
-                response=resp, content=self._try_to_serialize_error(resp))
+                response=resp,
+                content=self._try_to_serialize_error(resp, method))
         elif 500 <= resp.status_code <= 599:
             raise exceptions.HttpServerError(
                 "Server Error %s: %s" % (resp.status_code, url),
-                response=resp, content=self._try_to_serialize_error(resp))
+                response=resp,
+                content=self._try_to_serialize_error(resp, method))
 
         self._ = resp
 
         return resp
 
-    def _try_to_serialize_error(self, response):
+    def _stats_key(self, url, method):
+        return self._store.get('stats_key', _key)(url, method)
+
+    @contextmanager
+    def _phase(self, method, name):
+        """
+        Times the block as the phase `name` of a request, for the API's
+        instruments. The block can set the size of the phase in the dict
+        this yields.
+        """
+        instruments = self._store.get('instruments')
+        info = {'size': None}
+        if not instruments:
+            yield info
+            return
+        start = time.time()
+        yield info
+        self._emit(method, name, time.time() - start, info['size'])
+
+    def _emit(self, method, name, seconds, size=None):
+        key = self._stats_key(self._url(), method)
+        for instrument in self._store['instruments']:
+            instrument.phase(key, name, seconds, size=size)
+
+    def _send_phases(self, method, resp, seconds):
+        """
+        Splits the time taken by a request into sending it and waiting for
+        the first byte of the response, and downloading the body.
+        """
+        elapsed = getattr(resp, 'elapsed', None)
+        try:
+            size = int(resp.headers.get('content-length'))
+        except (TypeError, ValueError):
+            size = None
+        if not isinstance(elapsed, datetime.timedelta):
+            self._emit(method, 'send', seconds)
+            return
+        first_byte = min(elapsed.total_seconds(), seconds)
+        self._emit(method, 'send', first_byte)
+        self._emit(method, 'download', seconds - first_byte, size)
+
+    def _compress(self, stats_key, encoding, data, headers):
+        """
+        Compresses a body of at least compress_threshold bytes, returning the
+        body and the headers to send it with.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if (not isinstance(data, str) or
+                len(data) < self._store['compress_threshold']):
+            return data, headers
+        compressed = _compress(data, encoding)
+        statsd.timing('%s.request_size' % stats_key, len(data))
+        statsd.timing('%s.request_size.compressed' % stats_key,
+                      len(compressed))
+        headers = dict(headers or {})
+        headers['content-encoding'] = encoding
+        return compressed, headers
+
+    def _response_sizes(self, stats_key, resp):
+        """Sends the sizes of a compressed response, as sent and decoded."""
+        if not resp.headers.get('content-encoding'):
+            return
         try:
-            return self._try_to_serialize_response(response)
+            size = int(resp.headers.get('content-length'))
+        except (TypeError, ValueError):
+            return
+        statsd.timing('%s.response_size' % stats_key, len(resp.content))
+        statsd.timing('%s.response_size.compressed' % stats_key, size)
+
+    def _pool_gauges(self, url):
+        adapter = self._store['adapter']
+        pool = adapter.poolmanager.connection_from_url(url)
+        host = _stat_name(urlparse.urlparse(url).netloc)
+        for name, value in _pool_usage(pool).items():
+            statsd.gauge('curling.pool.%s.%s' % (host, name), value)
+
+    def _try_to_serialize_error(self, response, method='GET'):
+        try:
+            return self._try_to_serialize_response(response, method=method)
         except ValueError:
             return response
 
@@ -335,6 +1606,10 @@ class CurlingBase(object):
         This scheme is assuming that you've got two names and a primary key,
         if you would like a different parser you could pass in a new one.
         """
+        return self._cached_resource(('by_url', url, parser), self._by_url,
+                                     url, parser)
+
+    def _by_url(self, url, parser):
         parser = parser or default_parser
         resources, pk = parser(url)
         current = self
@@ -345,6 +1620,9 @@ class CurlingBase(object):
     def _add_callback(self, callback_dict):
         self._store.setdefault('callbacks', [])
         self._store['callbacks'].append(callback_dict)
+        # Resources already handed out were copied from the old store.
+        if self._store.get('resources') is not None:
+            self._store['resources'].clear()
 
     def activate_oauth(self, key, secret, realm='', params=None):
         params = params or {}
@@ -356,13 +1634,226 @@ class CurlingBase(object):
 
 
 def make_serializer(**kw):
+    backend = kw.pop('json_backend', _setting('json_backend', 'json'))
     serial = serialize.Serializer(default=kw.get('format', None))
-    serial.serializers['json'] = JsonSerializer()
+    serial.serializers['json'] = JsonSerializer(backend=backend)
     kw.setdefault('serializer', serial)
     return kw
 
 
 class API(TastypieAttributesMixin, CurlingBase, SlumberAPI):
+    """
+    On top of the slumber arguments, this takes:
+
+    * cache: a cache for GET responses, such as curling.cache.LocalCache or
+      curling.cache.DjangoCache. Cached responses are revalidated using their
+      ETag or Last-Modified headers.
+    * json_backend: the library used for JSON: json, simplejson, ujson or
+      auto. Defaults to the Django setting CURLING_JSON_BACKEND or json.
+    * lazy_lists: if True, Tastypie lists are returned as LazyTastypieList.
+      Defaults to the Django setting CURLING_LAZY_LISTS or False.
+    * retry: a RetryPolicy for retrying failed requests, by default there
+      are no retries.
+    * circuit_breaker: a CircuitBreaker to stop calling failing hosts.
+    * timeout: the timeout of each request in seconds, or a tuple of the
+      connect and read timeouts. Defaults to the Django setting
+      CURLING_TIMEOUT or None, no timeout.
+    * coalesce: if True, identical GETs made at the same time by several
+      threads share one request. Defaults to the Django setting
+      CURLING_COALESCE or False.
+    * instruments: a list of Instrument, to time the phases of each request.
+    * stats_key: a callable taking the URL and method of a request and
+      returning its statsd key. Defaults to a StatsKey, which replaces
+      primary keys in the URL with pk.
+    * transport: a curling.transport.Transport to send the requests, for
+      example to call a WSGI application in process. By default requests
+      are sent with the session.
+    * compress: gzip or deflate, to compress the bodies of POST, PUT and
+      PATCH requests and ask for compressed responses. Defaults to the
+      Django setting CURLING_COMPRESS or None, no compression.
+    * compress_threshold: the size in bytes from which bodies are
+      compressed. Defaults to the Django setting CURLING_COMPRESS_THRESHOLD
+      or 1024.
+    * projection_params: the names of the query parameters the server takes
+      for the fields to include and to exclude, e.g. ('fields', 'exclude'),
+      used by TastypieResource.projection. Defaults to the Django setting
+      CURLING_PROJECTION_PARAMS or None, the server isn't told.
+
+    And when it creates the session, the connection pool options:
+
+    * pool_connections: the number of hosts to keep connections to.
+    * pool_maxsize: the number of connections to keep to one host, set this
+      to the number of threads sharing the API.
+    * pool_block: if True, wait for a free connection rather than opening one
+      that won't be kept in the pool.
+    * max_retries: how many times to retry a failed connection.
+    * keep_alive: if False, close the connection after each request.
+    * pool_stats: if True, send statsd gauges of the connections in use.
+
+    Each of those defaults to the Django setting CURLING_ followed by the
+    upper case name, e.g. CURLING_POOL_MAXSIZE, or else the requests default.
+    """
+
+    pool_options = {
+        'pool_connections': DEFAULT_POOLSIZE,
+        'pool_maxsize': DEFAULT_POOLSIZE,
+        'pool_block': DEFAULT_POOLBLOCK,
+        'max_retries': DEFAULT_RETRIES,
+        'keep_alive': True,
+        'pool_stats': False,
+    }
+
+    def __init__(self, *args, **kw):
+        cache = kw.pop('cache', None)
+        retry = kw.pop('retry', None)
+        timeout = kw.pop('timeout', _setting('timeout', None))
+        coalesce = kw.pop('coalesce', _setting('coalesce', False))
+        instruments = kw.pop('instruments', None) or []
+        stats_key = kw.pop('stats_key', None) or _key
+        transport = kw.pop('transport', None)
+        compress = kw.pop('compress', _setting('compress', None))
+        threshold = kw.pop('compress_threshold',
+                           _setting('compress_threshold', 1024))
+        projection_params = kw.pop('projection_params',
+                                   _setting('projection_params', None))
+        if compress not in (None, 'gzip', 'deflate'):
+            raise ImproperlyConfigured('Unknown compress: %s' % compress)
+        circuit_breaker = kw.pop('circuit_breaker', None)
+        lazy_lists = kw.pop('lazy_lists', _setting('lazy_lists', False))
+        pool = dict((k, kw.pop(k, _setting(k, v)))
+                    for k, v in self.pool_options.items())
+        own_session = kw.get('session') is None
+        super(API, self).__init__(*args, **make_serializer(**kw))
+        self._store['cache'] = cache
+        self._store['retry'] = retry
+        self._store['timeout'] = timeout
+        self._store['inflight'] = SingleFlight() if coalesce else None
+        self._store['instruments'] = instruments
+        self._store['stats_key'] = stats_key
+        self._store['transport'] = transport
+        self._store['compress'] = compress
+        self._store['compress_threshold'] = threshold
+        self._store['projection_params'] = projection_params
+        self._store['circuit_breaker'] = circuit_breaker
+        self._store['lazy_lists'] = lazy_lists
+        self._store['resources'] = LocalCache(max_entries=1000, timeout=None)
+        if own_session:
+            self._configure_pool(**pool)
+
+    def _configure_pool(self, pool_connections, pool_maxsize, pool_block,
+                        max_retries, keep_alive, pool_stats):
+        session = self._store['session']
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=pool_block,
+                              max_retries=max_retries)
+        for prefix in ('http://', 'https://'):
+            session.mount(prefix, adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        self._store['adapter'] = adapter
+        self._store['pool_stats'] = pool_stats
+
+    def pool_status(self):
+        """
+        Returns the state of the connection pool to each host as a dict
+        of host to the maxsize, connections in use and connections opened.
+        """
+        adapter = self._store.get('adapter')
+        if adapter is None:
+            return {}
+        pools = adapter.poolmanager.pools
+        # Pool keys start with the scheme, host and port.
+        return dict(('%s:%s' % tuple(key[1:3]), _pool_usage(pools[key]))
+                    for key in pools.keys())
+
+
+class AsyncTastypieResource(TastypieResource):
+    """
+    A resource whose requests run on the worker threads of an AsyncAPI.
+
+    Methods like get, post or get_object return immediately with an
+    AsyncResult, call get on that to wait for the result (or the exception
+    raised by the request).
+    """
+
+    # The resource that does the actual requests in the worker threads.
+    _sync = TastypieResource
+
+    def __init__(self, *args, **kw):
+        super(AsyncTastypieResource, self).__init__(*args, **kw)
+        self._resource = self.__class__
+
+    def _submit(self, name, *args, **kw):
+        resource = self._sync(**self._store)
+        return self._store['pool'].apply_async(
+            getattr(resource, name), args, kw)
+
+    def get(self, *args, **kw):
+        return self._submit('get', *args, **kw)
+
+    def post(self, *args, **kw):
+        return self._submit('post', *args, **kw)
+
+    def patch(self, *args, **kw):
+        return self._submit('patch', *args, **kw)
+
+    def put(self, *args, **kw):
+        return self._submit('put', *args, **kw)
+
+    def delete(self, *args, **kw):
+        return self._submit('delete', *args, **kw)
+
+    def get_object(self, **kw):
+        return self._submit('get_object', **kw)
+
+    def get_object_or_404(self, **kw):
+        return self._submit('get_object_or_404', **kw)
+
+    def get_list_or_404(self, **kw):
+        return self._submit('get_list_or_404', **kw)
+
+    def iter_pages(self, *args, **kw):
+        return self._sync(**self._store).iter_pages(*args, **kw)
+
+    def iterate(self, *args, **kw):
+        return self._sync(**self._store).iterate(*args, **kw)
+
+    def get_all(self, *args, **kw):
+        return self._sync(**self._store).get_all(*args, **kw)
+
+    def bulk(self, *args, **kw):
+        # Sent in this thread, so that send can tell errors from results.
+        return self._sync(**self._store).bulk(*args, **kw)
+
+    def download(self, *args, **kw):
+        return self._submit('download', *args, **kw)
+
+    def get_many(self, *args, **kw):
+        return self._submit('get_many', *args, **kw)
+
+
+class AsyncAPI(API):
+    """
+    An API that runs requests on a pool of `workers` threads, sharing a
+    session with a connection pool of the same size, unless pool_maxsize
+    says otherwise. See AsyncTastypieResource.
+    """
 
     def __init__(self, *args, **kw):
-        return super(API, self).__init__(*args, **make_serializer(**kw))
+        workers = kw.pop('workers', 10)
+        kw.setdefault('pool_maxsize', workers)
+        super(AsyncAPI, self).__init__(*args, **kw)
+        self._resource = AsyncTastypieResource
+        self._store['pool'] = ThreadPool(workers)
+
+    def close(self):
+        """Waits for the pending requests and stops the worker threads."""
+        self._store['pool'].close()
+        self._store['pool'].join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,16 +1,39 @@
+import datetime
 import decimal
 import json
+import math
+import os
+import pickle
+import tempfile
+import threading
+import time
 import unittest
+import urllib
+import urlparse
+import zlib
+from collections import namedtuple
+from functools import partial
+from StringIO import StringIO
 
 import mock
+import oauthlib.oauth1
+import requests
 from django.conf import settings
-from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
+from django.conf.urls import url
+from django.http import Http404, HttpResponse
+from django.test.utils import override_settings
+from django.core.exceptions import (ImproperlyConfigured,
+                                    MultipleObjectsReturned,
+                                    ObjectDoesNotExist)
+from nose.plugins.skip import SkipTest
 from nose.tools import eq_, ok_, raises
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
 from slumber.exceptions import HttpClientError, HttpServerError
 
-import lib
+import cache
 import command
+import lib
+import transport
 
 
 def configure_settings():
@@ -113,16 +136,13 @@ def mock_response(method, url, **kw):
 
 class MockTastypieResource(MockAttributesMixin, lib.TastypieResource):
 
-    def _call_request(self, method, url, data, params, headers):
+    def _call_request(self, method, url, data, params, headers, **kw):
         return mock_response(
             method, url, data=data, params=params, headers=headers)
 
 
-class MockAPI(MockAttributesMixin, lib.CurlingBase, lib.SlumberAPI):
-
-    def __init__(self, *args, **kw):
-        return super(MockAPI, self).__init__(
-            *args, **lib.make_serializer(**kw))
+class MockAPI(MockAttributesMixin, lib.API):
+    pass
 
 
 class TestAPI(unittest.TestCase):
@@ -214,11 +234,828 @@ class TestAPI(unittest.TestCase):
             samples['GET:/services/fatalerror/']['content'])
 
 
+@mock.patch.object(MockTastypieResource, '_call_request')
+class TestBulk(unittest.TestCase):
+
+    def setUp(self):
+        self.api = MockAPI('http://foo.com')
+
+    def sent(self, _call_request):
+        return [json.loads(c[0][2]) for c in _call_request.call_args_list]
+
+    def test_chunks(self, _call_request):
+        _call_request.return_value = mock_response(
+            'PATCH', 'http://foo.com/services/settings/')
+        bulk = self.api.services.settings.bulk(chunk_size=2)
+        bulk.create({'key': 'a'})
+        bulk.update({'key': 'b', 'resource_uri': '/services/settings/b/'})
+        bulk.delete('/services/settings/c/')
+        results = bulk.send()
+        eq_(_call_request.call_args[0][0], 'PATCH')
+        eq_(self.sent(_call_request), [
+            {'objects': [{'key': 'a'},
+                         {'key': 'b', 'resource_uri': '/services/settings/b/'}
+                         ]},
+            {'objects': [], 'deleted_objects': ['/services/settings/c/']}])
+        eq_([(r['objects'], r['deleted_objects'], r['error'])
+             for r in results], [(2, 0, None), (0, 1, None)])
+        eq_(bulk.pending, [])
+
+    def test_errors(self, _call_request):
+        response = mock.Mock(status_code=400)
+        _call_request.side_effect = [
+            HttpClientError(response=response),
+            mock_response('PATCH', 'http://foo.com/services/settings/')]
+        bulk = self.api.services.settings.bulk(chunk_size=1)
+        bulk.create({'key': 'a'})
+        bulk.create({'key': 'b'})
+        results = bulk.send()
+        ok_(isinstance(results[0]['error'], HttpClientError))
+        eq_(results[1]['error'], None)
+
+    @raises(ValueError)
+    def test_update_needs_uri(self, _call_request):
+        self.api.services.settings.bulk().update({'key': 'a'})
+
+    def test_context(self, _call_request):
+        _call_request.return_value = mock_response(
+            'PATCH', 'http://foo.com/services/settings/')
+        with self.api.services.settings.bulk() as bulk:
+            for x in range(3):
+                bulk.create({'key': x})
+        eq_(_call_request.call_count, 1)
+        eq_(len(bulk.results), 1)
+
+
+@mock.patch.object(MockTastypieResource, '_call_request')
+class TestLazyList(unittest.TestCase):
+
+    content = json.dumps({
+        'meta': {'limit': 20, 'total_count': 185},
+        'objects': [{'key': 'ABSOLUTE_URL_OVERRIDES'}, {'key': 'ADMINS'}]
+    }, sort_keys=True)
+
+    def setUp(self):
+        self.api = MockAPI('http://foo.com', lazy_lists=True)
+
+    def response(self, content=None):
+        resp = mock_response('GET', '/services/settings/')
+        resp.content = content or self.content
+        return resp
+
+    def get(self):
+        return self.api.services.settings.get()
+
+    def test_meta(self, _call_request):
+        _call_request.return_value = self.response()
+        with mock.patch.object(lib.JsonSerializer, 'loads') as loads:
+            res = self.get()
+            ok_(isinstance(res, lib.LazyTastypieList))
+            eq_(res.total_count, 185)
+            eq_(res.limit, 20)
+            ok_(not loads.called)
+
+    def test_objects(self, _call_request):
+        _call_request.return_value = self.response()
+        res = self.get()
+        eq_(len(res), 2)
+        eq_(res[1], {'key': 'ADMINS'})
+        eq_([o['key'] for o in self.get()],
+            ['ABSOLUTE_URL_OVERRIDES', 'ADMINS'])
+        ok_(self.get())
+        eq_(self.get(), [{'key': 'ABSOLUTE_URL_OVERRIDES'}, {'key': 'ADMINS'}])
+
+    def test_get_object(self, _call_request):
+        _call_request.return_value = self.response()
+        self.assertRaises(MultipleObjectsReturned,
+                          self.api.services.settings.get_object)
+
+    def test_json(self, _call_request):
+        _call_request.return_value = self.response()
+        eq_(json.loads(json.dumps(self.get())), json.loads(
+            self.content)['objects'])
+
+    def test_add(self, _call_request):
+        _call_request.return_value = self.response()
+        eq_([o['key'] for o in [{'key': 'A'}] + self.get()],
+            ['A', 'ABSOLUTE_URL_OVERRIDES', 'ADMINS'])
+        eq_(len(self.get() + [{}]), 3)
+        self.assertRaises(TypeError, lambda: (1,) + self.get())
+        eq_(len(self.get() + self.get()), 4)
+
+    def test_compare(self, _call_request):
+        _call_request.return_value = self.response()
+        eq_(self.get(), self.get())
+        ok_(not self.get() < self.get())
+
+    def test_pickle(self, _call_request):
+        _call_request.return_value = self.response()
+        res = pickle.loads(pickle.dumps(self.get(), 2))
+        eq_(type(res), lib.TastypieList)
+        eq_(len(res), 2)
+        eq_(res.total_count, 185)
+
+    def test_other_order(self, _call_request):
+        _call_request.return_value = self.response(
+            '{"objects": [], "meta": {"total_count": 0}}')
+        res = self.get()
+        eq_(type(res), lib.TastypieList)
+        eq_(res.total_count, 0)
+
+    def test_not_a_list(self, _call_request):
+        _call_request.return_value = self.response('{"meta": {"a": 1}}')
+        eq_(self.get()['meta']['a'], 1)
+
+
+def status_response(status_code, headers=None):
+    resp = mock_response('GET', 'http://foo.com/services/settings/')
+    resp.status_code = status_code
+    resp.headers.update(headers or {})
+    return resp
+
+
+@mock.patch.object(lib.time, 'sleep')
+@mock.patch.object(MockTastypieResource, '_call_request')
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.retry = lib.RetryPolicy(max_attempts=3, backoff=1, jitter=False)
+        self.api = MockAPI('http://foo.com', retry=self.retry)
+        lib.statsd.reset()
+
+    def test_retry_status(self, _call_request, _sleep):
+        _call_request.side_effect = [status_response(503),
+                                     status_response(200)]
+        eq_(self.api.services.settings.get(), {})
+        eq_(_call_request.call_count, 2)
+        _sleep.assert_called_once_with(1)
+        eq_(lib.statsd.cache['services.settings.GET.retry|count'], [[1, 1]])
+
+    def test_retry_connection_error(self, _call_request, _sleep):
+        _call_request.side_effect = [ConnectionError, status_response(200)]
+        eq_(self.api.services.settings.get(), {})
+
+    def test_backoff(self, _call_request, _sleep):
+        _call_request.return_value = status_response(503)
+        self.assertRaises(HttpServerError, self.api.services.settings.get)
+        eq_(_call_request.call_count, 3)
+        eq_([c[0][0] for c in _sleep.call_args_list], [1, 2])
+        eq_(lib.statsd.cache['services.settings.GET.giveup|count'], [[1, 1]])
+
+    def test_jitter(self, _call_request, _sleep):
+        self.retry.jitter = True
+        _call_request.side_effect = [status_response(503),
+                                     status_response(200)]
+        self.api.services.settings.get()
+        ok_(0 <= _sleep.call_args[0][0] <= 1)
+
+    def test_retry_after(self, _call_request, _sleep):
+        _call_request.side_effect = [
+            status_response(503, {'retry-after': '4'}), status_response(200)]
+        self.api.services.settings.get()
+        _sleep.assert_called_once_with(4)
+
+    def test_retry_after_too_long(self, _call_request, _sleep):
+        _call_request.return_value = status_response(
+            503, {'retry-after': '86400'})
+        self.assertRaises(HttpServerError, self.api.services.settings.get)
+        eq_(_call_request.call_count, 1)
+        ok_(not _sleep.called)
+        eq_(lib.statsd.cache['services.settings.GET.giveup|count'], [[1, 1]])
+
+    def test_not_idempotent(self, _call_request, _sleep):
+        _call_request.return_value = status_response(503)
+        self.assertRaises(HttpServerError, self.api.services.settings.post,
+                          {})
+        eq_(_call_request.call_count, 1)
+
+    def test_other_status(self, _call_request, _sleep):
+        _call_request.return_value = status_response(500)
+        self.assertRaises(HttpServerError, self.api.services.settings.get)
+        eq_(_call_request.call_count, 1)
+
+    def test_signed_again(self, _call_request, _sleep):
+        self.api.activate_oauth('key', 'secret')
+        _call_request.side_effect = [status_response(503),
+                                     status_response(200)]
+        self.api.services.settings.get()
+        first, second = [c[0][4]['Authorization']
+                         for c in _call_request.call_args_list]
+        ok_(first != second)
+
+    def test_rewinds_file(self, _call_request, _sleep):
+        bodies = []
+
+        def call_request(method, url, data, params, headers, **kw):
+            bodies.append(data.read())
+            return status_response(503 if len(bodies) == 1 else 200)
+
+        _call_request.side_effect = call_request
+        body = StringIO('xxFOOBAR')
+        body.seek(2)
+        self.api.services.settings.put(body, binary_data=True)
+        eq_(bodies, ['FOOBAR', 'FOOBAR'])
+
+    def test_not_replayable(self, _call_request, _sleep):
+        _call_request.return_value = status_response(503)
+        self.assertRaises(HttpServerError, self.api.services.settings.put,
+                          iter(['FOO', 'BAR']), binary_data=True)
+        eq_(_call_request.call_count, 1)
+
+
+@mock.patch.object(lib.time, 'time')
+@mock.patch.object(MockTastypieResource, '_call_request')
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = lib.CircuitBreaker(failure_rate=0.5, min_requests=4,
+                                          reset_timeout=10)
+        self.api = MockAPI('http://foo.com', circuit_breaker=self.breaker)
+        lib.statsd.reset()
+
+    def fail(self, times):
+        for x in range(times):
+            self.assertRaises(HttpServerError, self.api.services.settings.get)
+
+    def test_opens(self, _call_request, _time):
+        _time.return_value = 0
+        _call_request.side_effect = ConnectionError
+        self.fail(4)
+        eq_(self.breaker.state('foo.com'), 'open')
+        eq_(lib.statsd.cache['curling.circuit.foo_com|gauge'], [[2, 1]])
+
+        _call_request.reset_mock()
+        self.assertRaises(lib.CircuitOpen, self.api.services.settings.get)
+        ok_(not _call_request.called)
+
+    def test_failure_rate(self, _call_request, _time):
+        _time.return_value = 0
+        _call_request.side_effect = [status_response(200)] * 3 + [
+            status_response(503)] * 3
+        self.api.services.settings.get()
+        self.api.services.settings.get()
+        self.api.services.settings.get()
+        self.fail(2)
+        eq_(self.breaker.state('foo.com'), 'closed')
+        self.fail(1)
+        eq_(self.breaker.state('foo.com'), 'open')
+
+    def test_client_errors(self, _call_request, _time):
+        _time.return_value = 0
+        _call_request.return_value = status_response(404)
+        for x in range(4):
+            self.assertRaises(HttpClientError, self.api.services.settings.get)
+        eq_(self.breaker.state('foo.com'), 'closed')
+
+    def test_half_open(self, _call_request, _time):
+        _time.return_value = 0
+        _call_request.side_effect = ConnectionError
+        self.fail(4)
+        _time.return_value = 11
+        _call_request.side_effect = None
+        _call_request.return_value = status_response(200)
+        self.api.services.settings.get()
+        eq_(self.breaker.state('foo.com'), 'closed')
+        eq_(self.breaker.status(),
+            {'foo.com': {'state': 'closed', 'requests': 0, 'failures': 0}})
+
+    def test_half_open_fails(self, _call_request, _time):
+        _time.return_value = 0
+        _call_request.side_effect = ConnectionError
+        self.fail(4)
+        _time.return_value = 11
+        self.fail(1)
+        eq_(self.breaker.state('foo.com'), 'open')
+        self.assertRaises(lib.CircuitOpen, self.api.services.settings.get)
+
+    def test_probes(self, _call_request, _time):
+        _time.return_value = 11
+        self.breaker._open('foo.com', self.breaker._circuit('foo.com'))
+        _time.return_value = 22
+        self.breaker.before('foo.com')
+        self.assertRaises(lib.CircuitOpen, self.breaker.before, 'foo.com')
+
+    def test_stale_result(self, _call_request, _time):
+        _time.return_value = 0
+        slow = self.breaker.before('foo.com')
+        eq_(slow, None)
+        self.breaker._open('foo.com', self.breaker._circuit('foo.com'))
+        _time.return_value = 11
+        probe = self.breaker.before('foo.com')
+        # The request started while closed times out after the probe.
+        self.breaker.record('foo.com', False, slow)
+        eq_(self.breaker.state('foo.com'), 'half_open')
+        self.breaker.record('foo.com', True, probe)
+        eq_(self.breaker.state('foo.com'), 'closed')
+
+    def test_other_host(self, _call_request, _time):
+        _time.return_value = 0
+        _call_request.side_effect = ConnectionError
+        self.fail(4)
+        eq_(self.breaker.state('bar.com'), 'closed')
+
+
+@mock.patch.object(lib.time, 'time')
+@mock.patch.object(MockTastypieResource, '_call_request')
+class TestTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.api = MockAPI('http://foo.com', timeout=5)
+        lib.statsd.reset()
+
+    def test_timeout(self, _call_request, _time):
+        _call_request.return_value = status_response(200)
+        self.api.services.settings.get()
+        eq_(_call_request.call_args[1], {'timeout': 5})
+
+    def test_no_timeout(self, _call_request, _time):
+        _call_request.return_value = status_response(200)
+        MockAPI('http://foo.com').services.settings.get()
+        eq_(_call_request.call_args[1], {})
+
+    def test_connect_read(self, _call_request, _time):
+        _time.return_value = 0
+        _call_request.return_value = status_response(200)
+        self.api._store['timeout'] = (1, 10)
+        self.api.services.settings.get(deadline=3)
+        eq_(_call_request.call_args[1], {'timeout': (1, 3)})
+
+    def test_deadline(self, _call_request, _time):
+        _time.return_value = 0
+        _call_request.return_value = status_response(200)
+        self.api.services.settings.post({}, deadline=2)
+        eq_(_call_request.call_args[1], {'timeout': 2})
+
+    @raises(lib.HttpTimeoutError)
+    def test_raises(self, _call_request, _time):
+        _time.return_value = 0
+        _call_request.side_effect = Timeout
+        try:
+            self.api.services.settings.get()
+        finally:
+            eq_(lib.statsd.cache['services.settings.GET.timeout|count'],
+                [[1, 1]])
+
+    def test_is_server_error(self, _call_request, _time):
+        _time.return_value = 0
+        _call_request.side_effect = Timeout
+        self.assertRaises(HttpServerError, self.api.services.settings.get)
+
+    def test_expired(self, _call_request, _time):
+        _time.return_value = 0
+        deadline = lib.Deadline(1)
+        _time.return_value = 2
+        self.assertRaises(lib.HttpTimeoutError,
+                          self.api.services.settings.get, deadline=deadline)
+        ok_(not _call_request.called)
+
+    @mock.patch.object(lib.time, 'sleep')
+    def test_retry(self, _sleep, _call_request, _time):
+        _time.return_value = 0
+        self.api._store['retry'] = lib.RetryPolicy(backoff=1, jitter=False)
+        _call_request.side_effect = [Timeout, Timeout]
+
+        def sleep(seconds):
+            _time.return_value += seconds
+        _sleep.side_effect = sleep
+
+        self.assertRaises(lib.HttpTimeoutError,
+                          self.api.services.settings.get, deadline=1.5)
+        eq_([c[1]['timeout'] for c in _call_request.call_args_list],
+            [1.5, 0.5])
+        eq_(lib.statsd.cache['services.settings.GET.giveup|count'], [[1, 1]])
+
+    def test_pages(self, _call_request, _time):
+        _time.return_value = 0
+
+        def response(*args, **kw):
+            _time.return_value += 1
+            return paged_response(5, *args, **kw)
+        _call_request.side_effect = response
+
+        pages = self.api.services.settings.iter_pages(deadline=2)
+        eq_(len(next(pages)), 2)
+        eq_(len(next(pages)), 2)
+        self.assertRaises(lib.HttpTimeoutError, next, pages)
+        eq_([c[1]['timeout'] for c in _call_request.call_args_list], [2, 1])
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = lib.SingleFlight()
+        self.gate = threading.Event()
+        self.calls = []
+
+    def slow(self, result):
+        self.calls.append(result)
+        self.gate.wait(5)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def run_all(self, func, count=4, call=None):
+        results = []
+        call = call or partial(self.flight.do, 'key', func)
+
+        def run():
+            try:
+                results.append(call())
+            except Exception, exc:
+                results.append(exc)
+
+        threads = [threading.Thread(target=run) for x in range(count)]
+        for thread in threads:
+            thread.start()
+        # Wait for the other threads to be waiting on the first one.
+        for x in range(500):
+            calls = self.flight._calls.values()
+            if calls and calls[0].waiters == count - 1:
+                break
+            time.sleep(0.01)
+        self.gate.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_shared(self):
+        eq_(self.run_all(partial(self.slow, 'result')), ['result'] * 4)
+        eq_(len(self.calls), 1)
+
+    def test_error(self):
+        error = ValueError('nope')
+        eq_(self.run_all(partial(self.slow, error)), [error] * 4)
+        eq_(len(self.calls), 1)
+
+    def test_not_in_flight(self):
+        self.gate.set()
+        self.flight.do('key', partial(self.slow, 1))
+        self.flight.do('key', partial(self.slow, 2))
+        eq_(self.calls, [1, 2])
+
+    @raises(lib.HttpTimeoutError)
+    def test_deadline(self):
+        self.flight._calls['key'] = lib._Call()
+        self.flight.do('key', partial(self.slow, 1),
+                       deadline=lib.Deadline(0.01))
+
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_api(self, _call_request):
+        api = MockAPI('http://foo.com', coalesce=True)
+        ok_(isinstance(api._store['inflight'], lib.SingleFlight))
+        _call_request.return_value = status_response(200)
+        with mock.patch.object(lib.SingleFlight, 'do') as do:
+            do.return_value = status_response(200)
+            api.services.settings.get(foo='bar')
+            ok_("('foo', 'bar')" in do.call_args[0][0])
+        eq_(api.services.settings.get(), {})
+
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_api_results_not_shared(self, _call_request):
+        api = MockAPI('http://foo.com', coalesce=True)
+        api._store['inflight'] = self.flight
+
+        def call_request(*args, **kw):
+            self.gate.wait(5)
+            return json_response(200, {'key': 'value'})
+
+        _call_request.side_effect = call_request
+        results = self.run_all(None, count=3,
+                               call=api.services.settings.get)
+        eq_(_call_request.call_count, 1)
+        results[0]['key'] = 'mutated'
+        eq_([r['key'] for r in results[1:]], ['value', 'value'])
+        ok_(results[1] is not results[2])
+
+
+class TestResourceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.api = MockAPI('http://foo.com')
+
+    def test_attributes(self):
+        ok_(self.api.services.settings is self.api.services.settings)
+        ok_(self.api.services.settings is not self.api.services.setting)
+
+    def test_call(self):
+        ok_(self.api.services.settings(3) is self.api.services.settings(3))
+        ok_(self.api.services.settings(3) is not
+            self.api.services.settings(4))
+        eq_(self.api.services.settings(3)._store['base_url'],
+            'http://foo.com/services/settings/3')
+
+    def test_by_url(self):
+        url = '/services/settings/3/'
+        ok_(self.api.by_url(url) is self.api.by_url(url))
+        ok_(self.api.by_url(url) is self.api.services.settings('3'))
+
+    def test_bounded(self):
+        self.api._store['resources'].max_entries = 2
+        for item in ['a', 'b', 'c']:
+            getattr(self.api, item)
+        eq_(len(self.api._store['resources']), 2)
+
+    def test_format_not_shared(self):
+        eq_(self.api.services(format='xml').settings._store['format'], 'xml')
+        eq_(self.api.services.settings._store['format'], 'json')
+        ok_(self.api.services.settings(3, format='xml') is not
+            self.api.services.settings(3))
+
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_no_format_lists_resource(self, _call_request):
+        _call_request.return_value = status_response(200)
+        self.api.services.settings.get()
+        eq_(self.api._store['resources'].get(
+            (MockTastypieResource, 'http://foo.com/services/settings',
+             'attr', 'format_lists')), None)
+
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_invalidated(self, _call_request):
+        settings = self.api.services.settings
+        self.api.activate_oauth('key', 'secret')
+        ok_(self.api.services.settings is not settings)
+        self.api.services.settings.get()
+        ok_('Authorization' in _call_request.call_args[0][4])
+
+
+def paged_response(total, method, url, data, params, headers, **kw):
+    """A Tastypie style list response that honours offset and limit."""
+    limit = int(params.get('limit', 2))
+    offset = int(params.get('offset', 0))
+    end = min(offset + limit, total)
+    next_url = None
+    if end < total:
+        next_url = '%s?limit=%s&offset=%s' % (url, limit, end)
+    resp = mock.Mock()
+    resp.status_code = 200
+    resp.headers = {'content-type': 'application/json'}
+    resp.content = json.dumps({
+        'meta': {'limit': limit, 'offset': offset, 'next': next_url,
+                 'total_count': total},
+        'objects': [{'pk': pk} for pk in range(offset, end)]
+    })
+    return resp
+
+
+@mock.patch.object(MockTastypieResource, '_call_request')
+class TestPagination(unittest.TestCase):
+
+    def setUp(self):
+        self.api = MockAPI('http://foo.com')
+
+    def test_iterate(self, _call_request):
+        _call_request.side_effect = partial(paged_response, 5)
+        eq_([o['pk'] for o in self.api.services.settings.iterate()],
+            range(5))
+        eq_(_call_request.call_count, 3)
+
+    def test_iterate_lazy(self, _call_request):
+        _call_request.side_effect = partial(paged_response, 5)
+        objects = self.api.services.settings.iterate()
+        eq_(next(objects), {'pk': 0})
+        eq_(_call_request.call_count, 1)
+
+    def test_iter_pages(self, _call_request):
+        _call_request.side_effect = partial(paged_response, 5)
+        pages = list(self.api.services.settings.iter_pages(limit=3))
+        eq_([len(p) for p in pages], [3, 2])
+        eq_(_call_request.call_args[0][3], {'limit': '3', 'offset': '3'})
+
+    def test_iter_pages_repeated_params(self, _call_request):
+        def call_request(method, url, data, params, headers, **kw):
+            resp = paged_response(4, method, url, data, params, headers)
+            content = json.loads(resp.content)
+            if content['meta']['next']:
+                query = dict(params, offset=2)
+                content['meta']['next'] = '%s?%s' % (
+                    url, urllib.urlencode(query, doseq=True))
+            resp.content = json.dumps(content)
+            return resp
+
+        _call_request.side_effect = call_request
+        pages = list(self.api.services.settings.iter_pages(
+            order_by=['name', 'id'], limit=2))
+        eq_([len(p) for p in pages], [2, 2])
+        eq_([c[0][3]['order_by'] for c in _call_request.call_args_list],
+            [['name', 'id'], ['name', 'id']])
+
+    def test_get_all(self, _call_request):
+        _call_request.side_effect = partial(paged_response, 11)
+        res = self.api.services.settings.get_all(concurrency=2, limit=2)
+        eq_([o['pk'] for o in res], range(11))
+        eq_(_call_request.call_count, 6)
+        offsets = sorted(c[0][3]['offset'] for c in
+                         _call_request.call_args_list[1:])
+        eq_(offsets, [2, 4, 6, 8, 10])
+
+    def test_get_all_one_page(self, _call_request):
+        _call_request.side_effect = partial(paged_response, 2)
+        eq_(len(list(self.api.services.settings.get_all())), 2)
+        eq_(_call_request.call_count, 1)
+
+    def test_iterate_not_a_list(self, _call_request):
+        _call_request.return_value = mock_response(
+            'GET', '/services/settings/APPEND_SLASH/')
+        eq_(list(self.api.services.settings.iterate()),
+            [{'key': 'APPEND_SLASH'}])
+
+
+@mock.patch.object(MockTastypieResource, '_call_request')
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.LocalCache()
+        self.api = MockAPI('http://foo.com', cache=self.cache)
+
+    def response(self, status_code=200, etag='"abc"'):
+        resp = mock_response('GET', '/services/settings/')
+        resp.status_code = status_code
+        if etag:
+            resp.headers['etag'] = etag
+        return resp
+
+    def test_revalidate(self, _call_request):
+        _call_request.return_value = self.response()
+        first = self.api.services.settings.get()
+        eq_(len(first), 2)
+        ok_('If-None-Match' not in _call_request.call_args[0][4])
+
+        _call_request.return_value = self.response(status_code=304)
+        eq_(self.api.services.settings.get(), first)
+        eq_(_call_request.call_args[0][4]['If-None-Match'], '"abc"')
+
+    def test_revalidated_not_shared(self, _call_request):
+        _call_request.return_value = self.response()
+        first = self.api.services.settings.get()
+        first[0]['key'] = 'mutated'
+        _call_request.return_value = self.response(status_code=304)
+        second = self.api.services.settings.get()
+        ok_(second is not first)
+        eq_(second[0]['key'], 'ABSOLUTE_URL_OVERRIDES')
+        second[0]['key'] = 'mutated'
+        eq_(self.api.services.settings.get()[0]['key'],
+            'ABSOLUTE_URL_OVERRIDES')
+
+    def test_last_modified(self, _call_request):
+        modified = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        _call_request.return_value = self.response(etag=None)
+        _call_request.return_value.headers['last-modified'] = modified
+        self.api.services.settings.get()
+        self.api.services.settings.get()
+        eq_(_call_request.call_args[0][4]['If-Modified-Since'], modified)
+
+    def test_no_validator(self, _call_request):
+        _call_request.return_value = self.response(etag=None)
+        self.api.services.settings.get()
+        eq_(len(self.cache), 0)
+
+    def test_params(self, _call_request):
+        _call_request.return_value = self.response()
+        self.api.services.settings.get(foo='bar')
+        self.api.services.settings.get(foo='baz')
+        ok_('If-None-Match' not in _call_request.call_args[0][4])
+
+    def test_credentials(self, _call_request):
+        _call_request.return_value = self.response()
+        self.api.services.settings.get()
+        self.api.activate_oauth('key', 'secret')
+        self.api.services.settings.get()
+        ok_('If-None-Match' not in _call_request.call_args[0][4])
+
+    def test_conditional_passed_through(self, _call_request):
+        _call_request.return_value = self.response(status_code=304)
+        res = self.api.services.settings.get(
+            headers={'If-None-Match': 'etag'})
+        eq_(res.status_code, 304)
+        eq_(len(self.cache), 0)
+
+
+class TestPool(unittest.TestCase):
+
+    def adapter(self, api):
+        return api._store['session'].get_adapter('http://foo.com')
+
+    def test_options(self):
+        api = lib.API('http://foo.com', pool_maxsize=25, max_retries=2)
+        eq_(self.adapter(api)._pool_maxsize, 25)
+        eq_(self.adapter(api).max_retries.total, 2)
+        eq_(api._store['session'].headers['Connection'], 'keep-alive')
+
+    def test_keep_alive(self):
+        api = lib.API('http://foo.com', keep_alive=False)
+        eq_(api._store['session'].headers['Connection'], 'close')
+
+    def test_settings(self):
+        with override_settings(CURLING_POOL_MAXSIZE=30):
+            api = lib.API('http://foo.com')
+        eq_(self.adapter(api)._pool_maxsize, 30)
+
+    def test_own_session(self):
+        session = requests.Session()
+        adapter = session.get_adapter('http://foo.com')
+        api = lib.API('http://foo.com', session=session, pool_maxsize=25)
+        ok_(self.adapter(api) is adapter)
+
+    def test_async(self):
+        with lib.AsyncAPI('http://foo.com', workers=3) as api:
+            eq_(self.adapter(api)._pool_maxsize, 3)
+
+    def test_status(self):
+        api = lib.API('http://foo.com', pool_maxsize=5)
+        self.adapter(api).poolmanager.connection_from_url('http://foo.com/')
+        eq_(api.pool_status(),
+            {'foo.com:80': {'maxsize': 5, 'in_use': 0, 'connections': 0}})
+
+    def test_gauges(self):
+        lib.statsd.reset()
+        api = MockAPI('http://foo.com', pool_stats=True, pool_maxsize=5)
+        api.services.settings.get()
+        eq_(lib.statsd.cache['curling.pool.foo_com.maxsize|gauge'],
+            [[5, 1]])
+        eq_(lib.statsd.cache['curling.pool.foo_com.in_use|gauge'],
+            [[0, 1]])
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def test_lru(self):
+        local = cache.LocalCache(max_entries=2)
+        local.set('a', 1)
+        local.set('b', 2)
+        local.get('a')
+        local.set('c', 3)
+        eq_(local.get('a'), 1)
+        eq_(local.get('b'), None)
+        eq_(local.get('c'), 3)
+
+    @mock.patch.object(cache.time, 'time')
+    def test_timeout(self, _time):
+        _time.return_value = 10
+        local = cache.LocalCache(timeout=5)
+        local.set('a', 1)
+        _time.return_value = 16
+        eq_(local.get('a'), None)
+
+
+class MockAsyncTastypieResource(lib.AsyncTastypieResource):
+
+    _sync = MockTastypieResource
+
+
+class TestAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.api = lib.AsyncAPI('', workers=2)
+        self.api._resource = MockAsyncTastypieResource
+
+    def tearDown(self):
+        self.api.close()
+
+    def test_get(self):
+        res = self.api.services.settings.get()
+        eq_(len(res.get(1)), 2)
+
+    def test_call(self):
+        res = self.api.services.settings('APPEND_SLASH').get()
+        eq_(res.get(1), {'key': 'APPEND_SLASH'})
+
+    def test_many(self):
+        results = [self.api.services.setting.get_object() for x in range(5)]
+        eq_([r.get(1) for r in results],
+            [{'key': 'ABSOLUTE_URL_OVERRIDES'}] * 5)
+
+    @raises(MultipleObjectsReturned)
+    def test_get_raises(self):
+        self.api.services.settings.get_object().get(1)
+
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_oauth(self, _call_request):
+        with lib.AsyncAPI('http://foo.com', workers=1) as api:
+            api._resource = MockAsyncTastypieResource
+            api.activate_oauth('key', 'secret')
+            api.services.settings.get().get(1)
+        authorization = _call_request.call_args[0][4]['Authorization']
+        assert 'OAuth ' in authorization, authorization
+
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_bulk(self, _call_request):
+        _call_request.return_value = status_response(500)
+        bulk = self.api.services.settings.bulk()
+        bulk.create({'key': 'FOO'})
+        results = bulk.send()
+        eq_(results[0]['result'], None)
+        ok_(isinstance(results[0]['error'], HttpServerError))
+
+
 @mock.patch.object(MockTastypieResource, '_call_request')
 class TestOAuth(unittest.TestCase):
 
     def setUp(self):
         self.api = MockAPI('http://foo.com')
+        lib._oauth_clients.clear()
+
+    def tearDown(self):
+        lib._oauth_clients.clear()
 
     def test_none(self, _call_request):
         self.api.services.settings.get()
@@ -251,7 +1088,7 @@ class TestOAuth(unittest.TestCase):
             mock.ANY)
         assert 'oauth_token' not in _call_request.call_args[0][-1]
 
-        with mock.patch.object(lib.oauthlib.oauth1.Client, 'sign') as _sign:
+        with mock.patch.object(oauthlib.oauth1.Client, 'sign') as _sign:
             _sign.return_value = 'dummy-url', {}, {}
             self.api.services.settings.get(foo='bar')
             _sign.assert_called_with(
@@ -273,7 +1110,7 @@ class TestOAuth(unittest.TestCase):
         assert 'OAuth ' in authorization, authorization
         assert 'oauth_token="f"' in authorization, authorization
 
-        with mock.patch.object(lib.oauthlib.oauth1.Client, 'sign') as _sign:
+        with mock.patch.object(oauthlib.oauth1.Client, 'sign') as _sign:
             _sign.return_value = 'dummy-url', {}, {}
             self.api.services.settings.get(foo='bar')
             _sign.assert_called_with(
@@ -284,6 +1121,33 @@ class TestOAuth(unittest.TestCase):
                 http_method='GET',
                 realm='')
 
+    def test_client_reused(self, _call_request):
+        self.api.activate_oauth('key', 'secret')
+        with mock.patch.object(oauthlib.oauth1, 'Client') as _client:
+            _client.return_value.sign.return_value = 'dummy-url', {}, {}
+            self.api.services.settings.get()
+            self.api.services.settings.get(foo='bar')
+            eq_(_client.call_count, 1)
+
+    def test_client_per_token(self, _call_request):
+        self.api.activate_oauth('key', 'secret')
+        with mock.patch.object(oauthlib.oauth1, 'Client') as _client:
+            _client.return_value.sign.return_value = 'dummy-url', {}, {}
+            self.api.services.settings.get()
+            self.api.services.settings.get(oauth_token='f')
+            eq_(_client.call_count, 2)
+
+    def test_verifier_not_kept(self, _call_request):
+        self.api.activate_oauth('key', 'secret')
+        with mock.patch.object(oauthlib.oauth1, 'Client') as _client:
+            _client.return_value.sign.return_value = 'dummy-url', {}, {}
+            self.api.services.settings.get(oauth_token='f',
+                                           oauth_verifier='v')
+            self.api.services.settings.get(oauth_token='f',
+                                           oauth_verifier='v')
+            eq_(_client.call_count, 2)
+        eq_(len(lib._oauth_clients), 0)
+
     @raises(ValueError)
     def test_merge_conflict(self, _call_request):
         self.api.activate_oauth('key', 'secret', params={'oauth_token': 'f'})
@@ -344,6 +1208,155 @@ class TestStatsd(unittest.TestCase):
         eq_(lib.statsd.cache, {'services.settings.PATCH.200|count': [[1, 1]]})
 
 
+class RecordingInstrument(lib.Instrument):
+
+    def __init__(self):
+        self.phases = []
+
+    def phase(self, key, name, seconds, size=None):
+        self.phases.append((key, name, size))
+
+
+class TestInstruments(unittest.TestCase):
+
+    def setUp(self):
+        self.instrument = RecordingInstrument()
+        self.api = MockAPI('http://foo.com', instruments=[self.instrument])
+        lib.statsd.reset()
+
+    def names(self):
+        return [name for key, name, size in self.instrument.phases]
+
+    def test_off(self):
+        api = MockAPI('http://foo.com')
+        api.services.settings.get()
+        eq_(len(lib.statsd.timings), 1)
+
+    def test_get(self):
+        self.api.services.settings.get()
+        eq_(self.names(), ['send', 'decode'])
+        eq_(self.instrument.phases[-1],
+            ('services.settings.GET', 'decode', 2))
+
+    def test_post(self):
+        self.api.services.settings.post({'foo': 'bar'})
+        eq_(self.names(), ['serialize', 'send', 'decode'])
+        eq_(self.instrument.phases[0],
+            ('services.settings.POST', 'serialize', 14))
+
+    def test_binary_data(self):
+        self.api.services.settings.post('foo', binary_data=True)
+        eq_(self.names(), ['send', 'decode'])
+
+    def test_callbacks(self):
+        self.api.activate_oauth('key', 'secret')
+        self.api.services.settings.get()
+        eq_(self.names(), ['callbacks', 'send', 'decode'])
+
+    def test_list(self):
+        lib.mock_lookup['GET:http://foo.com/services/list/'] = {
+            'content': json.dumps({'meta': {}, 'objects': [{}, {}]})}
+        try:
+            self.api.services.list.get()
+        finally:
+            del lib.mock_lookup['GET:http://foo.com/services/list/']
+        eq_(self.names(), ['send', 'decode', 'format_list'])
+        eq_(self.instrument.phases[-1][2], 2)
+
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_download(self, _call_request):
+        resp = status_response(200, {'content-length': '2'})
+        resp.elapsed = datetime.timedelta(seconds=0)
+        _call_request.return_value = resp
+        self.api.services.settings.get()
+        eq_(self.names(), ['send', 'download', 'decode'])
+        eq_(self.instrument.phases[1],
+            ('services.settings.GET', 'download', 2))
+
+    def test_statsd(self):
+        api = MockAPI('http://foo.com',
+                      instruments=[lib.StatsdInstrument()])
+        api.services.settings.post({})
+        keys = set(t[0].split('|')[0] for t in lib.statsd.timings)
+        eq_(keys, set(['services.settings.POST',
+                       'services.settings.POST.decode',
+                       'services.settings.POST.decode.size',
+                       'services.settings.POST.send',
+                       'services.settings.POST.serialize',
+                       'services.settings.POST.serialize.size']))
+
+
+Point = namedtuple('Point', 'x y')
+
+
+def json_types(value):
+    """Decoded JSON with each value paired with its type."""
+    if isinstance(value, dict):
+        return sorted((json_types(k), json_types(v))
+                      for k, v in value.items())
+    if isinstance(value, list):
+        return [json_types(v) for v in value]
+    return (type(value), value)
+
+
+class TestJsonBackend(unittest.TestCase):
+
+    data = {
+        'amount': decimal.Decimal('1.10'),
+        'date': datetime.date(2013, 1, 2),
+        'datetime': datetime.datetime(2013, 1, 2, 3, 4, 5),
+        'time': datetime.time(3, 4, 5),
+        'list': [1, 'a', None, True],
+        'namedtuple': Point(1, 2),
+    }
+
+    def serializer(self, backend):
+        try:
+            return lib.JsonSerializer(backend=backend)
+        except ImproperlyConfigured:
+            raise SkipTest('%s is not installed' % backend)
+
+    def check(self, backend):
+        serializer = self.serializer(backend)
+        expected = json.dumps(self.data, cls=lib.Encoder, sort_keys=True)
+        eq_(json.dumps(json.loads(serializer.dumps(self.data)),
+                       sort_keys=True), expected)
+        eq_(json_types(serializer.loads(expected)),
+            json_types(json.loads(expected)))
+
+    def check_nan(self, backend):
+        serializer = self.serializer(backend)
+        eq_(serializer.dumps([float('nan')]), '[NaN]')
+        ok_(math.isnan(serializer.loads('[NaN]')[0]))
+
+    def test_json(self):
+        self.check('json')
+        self.check_nan('json')
+
+    def test_simplejson(self):
+        self.check('simplejson')
+        self.check_nan('simplejson')
+
+    def test_ujson(self):
+        self.check('ujson')
+
+    def test_auto(self):
+        self.check('auto')
+        self.check_nan('auto')
+
+    @raises(ImproperlyConfigured)
+    def test_unknown(self):
+        lib.JsonSerializer(backend='nope')
+
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_api(self, _call_request):
+        self.serializer('simplejson')
+        api = MockAPI('http://foo.com', json_backend='simplejson')
+        eq_(api._store['serializer'].get_serializer().backend, 'simplejson')
+        api.services.settings.post({'amount': decimal.Decimal('1.0')})
+        eq_(json.loads(_call_request.call_args[0][2]), {u'amount': u'1.0'})
+
+
 def test_parser():
     for k, v in [
             ('/a/b/1', (('a', 'b', '1'), None)),
@@ -352,6 +1365,479 @@ def test_parser():
         eq_(lib.safe_parser(k), v)
 
 
+def test_key_parser():
+    for k, v in [
+            ('/a/b/', ['a', 'b']),
+            ('/a/b/8/', ['a', 'b', 'pk']),
+            ('/a/b/set/1;2;3/', ['a', 'b', 'set', 'pk']),
+            ('/a/b/5ad7d9a4-3c1e-4e36-8f0b-2f6a1f9a3e01/c/',
+             ['a', 'b', 'pk', 'c']),
+            ('/a/b/%s/' % ('f' * 40), ['a', 'b', 'pk']),
+            ('/a/b2/v1/', ['a', 'b2', 'v1'])]:
+        eq_(lib.key_parser(k), v)
+
+
+class TestStatsKey(unittest.TestCase):
+
+    def test_key(self):
+        key = lib.StatsKey()
+        eq_(key('http://foo.com/services/settings/8/?a=b', 'GET'),
+            'services.settings.pk.GET')
+
+    def test_raw(self):
+        key = lib.StatsKey(parser=lib.raw_key_parser)
+        eq_(key('http://foo.com/services/settings/8/', 'GET'),
+            'services.settings.8.GET')
+
+    def test_path(self):
+        eq_(lib._url_path('http://foo.com/a/b/?c=d#e'), '/a/b/')
+        eq_(lib._url_path('http://foo.com'), '/')
+        eq_(lib._url_path('/a/b/'), '/a/b/')
+
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_api(self, _call_request):
+        _call_request.return_value = status_response(200)
+        lib.statsd.reset()
+        api = MockAPI('http://foo.com')
+        api.services.settings(1).get()
+        eq_(lib.statsd.cache,
+            {'services.settings.pk.GET.200|count': [[1, 1]]})
+
+    def test_custom(self):
+        lib.statsd.reset()
+        api = MockAPI('http://foo.com',
+                      stats_key=lambda url, method: 'solitude.%s' % method)
+        api.services.settings.get()
+        eq_(lib.statsd.cache, {'solitude.GET.200|count': [[1, 1]]})
+
+
+def wsgi_app(environ, start_response):
+    body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+    start_response('201 CREATED', [('Content-Type', 'application/json')])
+    return [json.dumps({
+        'method': environ['REQUEST_METHOD'],
+        'path': environ['PATH_INFO'],
+        'query': environ['QUERY_STRING'],
+        'host': environ['SERVER_NAME'],
+        'accept': environ.get('HTTP_ACCEPT'),
+        'content_type': environ.get('CONTENT_TYPE'),
+        'body': body})]
+
+
+class TestTransport(unittest.TestCase):
+
+    def test_wsgi(self):
+        api = lib.API('http://foo.com',
+                      transport=transport.WSGITransport(wsgi_app))
+        res = api.services.settings.post({'a': 'b'}, foo='bar')
+        eq_(res['method'], 'POST')
+        eq_(res['path'], '/services/settings/')
+        eq_(res['query'], 'foo=bar')
+        eq_(res['host'], 'foo.com')
+        eq_(res['accept'], 'application/json')
+        eq_(res['content_type'], 'application/json')
+        eq_(json.loads(res['body']), {'a': 'b'})
+
+    def test_recorded(self):
+        recorded = transport.RecordedTransport()
+        recorded.add('GET', 'http://foo.com/services/settings/1/',
+                     content={'key': 'value'})
+        api = lib.API('http://foo.com', transport=recorded)
+        eq_(api.services.settings(1).get(), {'key': 'value'})
+        eq_(recorded.calls[0][:2],
+            ('GET', 'http://foo.com/services/settings/1/'))
+
+    @raises(transport.NoRecordedResponse)
+    def test_not_recorded(self):
+        api = lib.API('http://foo.com',
+                      transport=transport.RecordedTransport())
+        api.services.settings.get()
+
+    @raises(HttpClientError)
+    def test_recorded_status(self):
+        recorded = transport.RecordedTransport()
+        recorded.add('GET', 'http://foo.com/services/settings/', 404)
+        lib.API('http://foo.com', transport=recorded).services.settings.get()
+
+    def test_record(self):
+        recorded = transport.RecordedTransport(
+            transport=transport.WSGITransport(wsgi_app))
+        api = lib.API('http://foo.com', transport=recorded)
+        api.services.settings.get(foo='bar')
+        output = StringIO()
+        recorded.dump(output)
+        output.seek(0)
+        replay = transport.RecordedTransport.load(output)
+        api = lib.API('http://foo.com', transport=replay)
+        eq_(api.services.settings.get(foo='bar')['query'], 'foo=bar')
+
+    def test_session(self):
+        session = mock.Mock()
+        session.request.return_value = status_response(200)
+        api = lib.API('http://foo.com',
+                      transport=transport.SessionTransport(session))
+        api.services.settings.get(timeout=1)
+        eq_(session.request.call_args[1]['params'], {'timeout': 1})
+
+    def test_urllib3(self):
+        pool = mock.Mock()
+        pool.urlopen.return_value = mock.Mock(
+            status=200, data='{"a": "b"}', reason='OK',
+            headers={'content-type': 'application/json'})
+        api = lib.API('http://foo.com', timeout=(1, 2),
+                      transport=transport.Urllib3Transport(pool))
+        eq_(api.services.settings.get(foo='bar'), {'a': 'b'})
+        args, kw = pool.urlopen.call_args
+        eq_(args, ('GET', 'http://foo.com/services/settings/?foo=bar'))
+        eq_(kw['timeout'].connect_timeout, 1)
+        eq_(kw['timeout'].read_timeout, 2)
+
+    @raises(lib.HttpTimeoutError)
+    def test_urllib3_timeout(self):
+        pool = mock.Mock()
+        pool.urlopen.side_effect = (
+            transport.urllib3.exceptions.ReadTimeoutError(None, '/', 'slow'))
+        api = lib.API('http://foo.com',
+                      transport=transport.Urllib3Transport(pool))
+        api.services.settings.get()
+
+
+def settings_view(request, pk=None):
+    if pk == '404':
+        raise Http404
+    if pk == '500':
+        raise ValueError('broken')
+    return HttpResponse(json.dumps({'method': request.method, 'pk': pk,
+                                    'foo': request.GET.get('foo'),
+                                    'body': request.body}),
+                        content_type='application/json', status=201)
+
+
+class urls(object):
+    urlpatterns = [
+        url(r'^services/settings/(?:(?P<pk>[^/]+)/)?$', settings_view),
+    ]
+
+
+class TestDjangoTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.api = lib.API('http://foo.com',
+                           transport=transport.DjangoTransport(urls))
+
+    def test_get(self):
+        eq_(self.api.services.settings(1).get(foo='bar'),
+            {'method': 'GET', 'pk': '1', 'foo': 'bar', 'body': ''})
+
+    def test_post(self):
+        res = self.api.services.settings.post({'a': 'b'})
+        eq_(res['method'], 'POST')
+        eq_(json.loads(res['body']), {'a': 'b'})
+
+    @raises(HttpClientError)
+    def test_not_found(self):
+        self.api.services.settings(404).get()
+
+    @raises(HttpClientError)
+    def test_no_url(self):
+        self.api.services.nope.get()
+
+    @mock.patch.object(transport.logging, 'getLogger')
+    def test_error(self, getLogger):
+        with self.assertRaises(HttpServerError):
+            self.api.services.settings(500).get()
+        ok_(getLogger.return_value.error.called)
+
+    @raises(ValueError)
+    def test_propagate(self):
+        with override_settings(DEBUG_PROPAGATE_EXCEPTIONS=True):
+            self.api.services.settings(500).get()
+
+    def test_statsd(self):
+        lib.statsd.reset()
+        self.api.services.settings(1).get()
+        eq_(lib.statsd.cache,
+            {'services.settings.pk.GET.201|count': [[1, 1]]})
+
+
+def json_response(status_code, content):
+    resp = status_response(status_code)
+    resp.content = json.dumps(content)
+    return resp
+
+
+@mock.patch.object(MockTastypieResource, '_call_request')
+class TestGetMany(unittest.TestCase):
+
+    def setUp(self):
+        self.api = MockAPI('http://foo.com')
+        self.base = 'http://foo.com/services/settings/'
+
+    def urls(self, _call_request):
+        return [c[0][1] for c in _call_request.call_args_list]
+
+    def test_set(self, _call_request):
+        _call_request.return_value = json_response(
+            200, {'objects': [{'id': 1}, {'id': 3}], 'not_found': ['2']})
+        res = self.api.services.settings.get_many([1, 2, 3, 1])
+        eq_(self.urls(_call_request), [self.base + 'set/1;2;3/'])
+        eq_(res[1], {'id': 1})
+        eq_(res[3], {'id': 3})
+        ok_(isinstance(res[2], ObjectDoesNotExist))
+
+    def test_chunks(self, _call_request):
+        def call_request(method, url, data, params, headers, **kw):
+            ids = url.split('/')[-2].split(';')
+            return json_response(
+                200, {'objects': [{'key': i} for i in ids]})
+
+        _call_request.side_effect = call_request
+        res = self.api.services.settings.get_many(
+            ['a', 'b', 'c'], chunk_size=2, pk_field='key')
+        eq_(sorted(self.urls(_call_request)),
+            [self.base + 'set/a;b/', self.base + 'set/c/'])
+        eq_(res, {'a': {'key': 'a'}, 'b': {'key': 'b'}, 'c': {'key': 'c'}})
+
+    def test_fallback(self, _call_request):
+        def call_request(method, url, data, params, headers, **kw):
+            if '/set/' in url or url.endswith('/2/'):
+                return json_response(404, {})
+            if url.endswith('/3/'):
+                return json_response(500, {})
+            return json_response(200, {'id': 1})
+
+        _call_request.side_effect = call_request
+        res = self.api.services.settings.get_many([1, 2, 3])
+        eq_(sorted(self.urls(_call_request)),
+            [self.base + '1/', self.base + '2/', self.base + '3/',
+             self.base + 'set/1;2;3/'])
+        eq_(res[1], {'id': 1})
+        ok_(isinstance(res[2], ObjectDoesNotExist))
+        ok_(isinstance(res[3], HttpServerError))
+
+    def test_server_error(self, _call_request):
+        _call_request.side_effect = [
+            json_response(200, {'objects': [{'id': 1}]}),
+            json_response(503, {})]
+        res = self.api.services.settings.get_many([1, 2], chunk_size=1)
+        eq_(res[1], {'id': 1})
+        ok_(isinstance(res[2], HttpServerError))
+        eq_(_call_request.call_count, 2)
+
+    @raises(HttpClientError)
+    def test_rate_limited(self, _call_request):
+        _call_request.return_value = json_response(429, {})
+        try:
+            self.api.services.settings.get_many(range(50))
+        finally:
+            eq_(_call_request.call_count, 1)
+
+    def test_programming_error(self, _call_request):
+        _call_request.side_effect = TypeError('bug')
+        with self.assertRaises(TypeError):
+            self.api.services.settings.get_many([1, 2])
+
+    def test_empty(self, _call_request):
+        eq_(self.api.services.settings.get_many([]), {})
+        ok_(not _call_request.called)
+
+
+@mock.patch.object(MockTastypieResource, '_call_request')
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.api = MockAPI('http://foo.com', compress='gzip',
+                           compress_threshold=100)
+        self.data = {'key': 'x' * 200}
+        lib.statsd.reset()
+
+    def test_gzip(self, _call_request):
+        _call_request.return_value = status_response(200)
+        self.api.services.settings.post(self.data)
+        body, params, headers = _call_request.call_args[0][2:]
+        eq_(headers['content-encoding'], 'gzip')
+        eq_(headers['accept-encoding'], 'gzip, deflate')
+        eq_(json.loads(zlib.decompress(body, zlib.MAX_WBITS | 16)),
+            self.data)
+        ok_('services.settings.POST.request_size.compressed|timing' in
+            [t[0] for t in lib.statsd.timings])
+
+    def test_deflate(self, _call_request):
+        _call_request.return_value = status_response(200)
+        api = MockAPI('http://foo.com', compress='deflate',
+                      compress_threshold=0)
+        api.services.settings.put(self.data)
+        body, params, headers = _call_request.call_args[0][2:]
+        eq_(headers['content-encoding'], 'deflate')
+        eq_(json.loads(zlib.decompress(body)), self.data)
+
+    def test_small(self, _call_request):
+        _call_request.return_value = status_response(200)
+        self.api.services.settings.post({'key': 'x'})
+        body, params, headers = _call_request.call_args[0][2:]
+        ok_('content-encoding' not in headers)
+        eq_(json.loads(body), {'key': 'x'})
+
+    def test_binary_data(self, _call_request):
+        _call_request.return_value = status_response(200)
+        self.api.services.settings.post('x' * 200, binary_data=True)
+        eq_(_call_request.call_args[0][2], 'x' * 200)
+
+    def test_off(self, _call_request):
+        _call_request.return_value = status_response(200)
+        MockAPI('http://foo.com').services.settings.post(self.data)
+        headers = _call_request.call_args[0][4]
+        ok_('accept-encoding' not in headers)
+        ok_('content-encoding' not in headers)
+
+    def test_response_sizes(self, _call_request):
+        resp = status_response(200, {'content-encoding': 'gzip',
+                                     'content-length': '20'})
+        resp.content = json.dumps(self.data)
+        _call_request.return_value = resp
+        self.api.services.settings.get()
+        timings = dict((t[0], t[2]) for t in lib.statsd.timings)
+        eq_(timings['services.settings.GET.response_size.compressed|timing'],
+            20)
+        eq_(timings['services.settings.GET.response_size|timing'],
+            len(resp.content))
+
+    @raises(ImproperlyConfigured)
+    def test_unknown(self, _call_request):
+        MockAPI('http://foo.com', compress='br')
+
+    def test_setting(self, _call_request):
+        _call_request.return_value = status_response(200)
+        with override_settings(CURLING_COMPRESS='deflate',
+                               CURLING_COMPRESS_THRESHOLD=0):
+            api = MockAPI('http://foo.com')
+        api.services.settings.post({})
+        eq_(_call_request.call_args[0][4]['content-encoding'], 'deflate')
+
+
+@mock.patch.object(MockTastypieResource, '_call_request')
+class TestProjection(unittest.TestCase):
+
+    def setUp(self):
+        self.api = MockAPI('http://foo.com')
+        self.objects = [{'id': 1, 'key': 'a', 'value': 'x' * 100},
+                        {'id': 2, 'key': 'b', 'value': 'y' * 100}]
+        self.content = {'meta': {'limit': 2, 'total_count': 2},
+                        'objects': self.objects}
+
+    def test_fields(self, _call_request):
+        _call_request.return_value = json_response(200, self.content)
+        res = self.api.services.settings.projection(
+            fields=['id', 'key']).get_list_or_404()
+        eq_(list(res), [{'id': 1, 'key': 'a'}, {'id': 2, 'key': 'b'}])
+        eq_(res.total_count, 2)
+        eq_(_call_request.call_args[0][3], {})
+
+    def test_exclude(self, _call_request):
+        _call_request.return_value = json_response(200, self.objects[0])
+        res = self.api.services.settings.projection(exclude=['value'])(1)
+        eq_(res.get(), {'id': 1, 'key': 'a'})
+
+    def test_lazy(self, _call_request):
+        _call_request.return_value = json_response(200, self.content)
+        api = MockAPI('http://foo.com', lazy_lists=True)
+        res = api.services.settings.projection(fields=['key']).get()
+        ok_(isinstance(res, lib.LazyTastypieList))
+        eq_(list(res), [{'key': 'a'}, {'key': 'b'}])
+
+    def test_params(self, _call_request):
+        _call_request.return_value = json_response(200, self.content)
+        api = MockAPI('http://foo.com',
+                      projection_params=('fields', 'exclude'))
+        api.services.settings.projection(
+            fields=['key', 'id'], exclude=['value']).get(limit=2)
+        eq_(_call_request.call_args[0][3],
+            {'fields': 'id,key', 'exclude': 'value', 'limit': 2})
+
+    def test_not_shared(self, _call_request):
+        _call_request.return_value = json_response(200, self.objects[0])
+        self.api.services.settings.projection(fields=['id'])(1).get()
+        eq_(self.api.services.settings(1).get(), self.objects[0])
+
+    def test_errors(self, _call_request):
+        _call_request.return_value = json_response(400, {'error': 'bad'})
+        with self.assertRaises(HttpClientError) as context:
+            self.api.services.settings.projection(fields=['id']).get()
+        eq_(context.exception.content, {'error': 'bad'})
+
+    def test_cache_key(self, _call_request):
+        settings = self.api.services.settings
+        ok_(settings._cache_key({}, {}) !=
+            settings.projection(fields=['id'])._cache_key({}, {}))
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.api = MockAPI('http://foo.com')
+
+    def test_iter_chunks(self):
+        eq_(list(lib.iter_chunks(StringIO('FOOBAR'), chunk_size=4)),
+            ['FOOB', 'AR'])
+
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_upload(self, _call_request):
+        _call_request.return_value = status_response(200)
+        body = lib.iter_chunks(StringIO('FOOBAR'))
+        self.api.services.settings.post(body, binary_data=True)
+        eq_(_call_request.call_args[0][2], body)
+
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_download(self, _call_request):
+        resp = status_response(200)
+        resp.iter_content.return_value = iter(['FOO', 'BAR'])
+        _call_request.return_value = resp
+        eq_(list(self.api.services.settings.download(chunk_size=3)),
+            ['FOO', 'BAR'])
+        eq_(_call_request.call_args[1], {'stream': True})
+        resp.iter_content.assert_called_with(3)
+
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_download_file(self, _call_request):
+        resp = status_response(200)
+        resp.iter_content.return_value = iter(['FOO', 'BAR'])
+        _call_request.return_value = resp
+        output = StringIO()
+        eq_(self.api.services.settings.download(output), 6)
+        eq_(output.getvalue(), 'FOOBAR')
+
+    @raises(HttpClientError)
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_download_error(self, _call_request):
+        _call_request.return_value = status_response(404)
+        self.api.services.settings.download()
+
+    def test_download_wsgi(self):
+        api = lib.API('http://foo.com',
+                      transport=transport.WSGITransport(wsgi_app))
+        eq_(json.loads(''.join(api.services.settings.download()))['path'],
+            '/services/settings/')
+
+    def test_upload_wsgi(self):
+        api = lib.API('http://foo.com',
+                      transport=transport.WSGITransport(wsgi_app))
+        res = api.services.settings.post(iter(['FOO', 'BAR']),
+                                         binary_data=True)
+        eq_(res['body'], 'FOOBAR')
+
+    def test_urllib3_chunked(self):
+        pool = mock.Mock()
+        pool.urlopen.return_value = mock.Mock(
+            status=200, data='{}', reason='OK',
+            headers={'content-type': 'application/json'})
+        api = lib.API('http://foo.com',
+                      transport=transport.Urllib3Transport(pool))
+        api.services.settings.post(iter(['FOO']), binary_data=True)
+        ok_(pool.urlopen.call_args[1]['chunked'])
+        api.services.settings.post('FOO', binary_data=True)
+        ok_(not pool.urlopen.call_args[1]['chunked'])
+
+
 class TestCommand(unittest.TestCase):
 
     def setUp(self):
@@ -457,10 +1943,19 @@ class TestCommand(unittest.TestCase):
     @mock.patch.object(command.sys, 'stdin')
     def test_some_binary_data_stdin(self, _stdin_mock, _call_request, _show):
         data = 'FOOBAR'
-        _stdin_mock.readlines.return_value = data
+        _stdin_mock.fileno.side_effect = AttributeError
+        _stdin_mock.read.side_effect = ['FOO', 'BAR', '']
         config = self.setup_config(binary_data='@-')
-        _call_request.return_value = mock_response(self.method, self.url)
+        chunks = []
+
+        def call_request(method, url, data, params, headers, **kw):
+            chunks.extend(data)
+            return mock_response(self.method, self.url)
+
+        _call_request.side_effect = call_request
         result = command.new(config, lib_api=self.api)
+        eq_(chunks, ['FOO', 'BAR'])
+        data = _call_request.call_args[0][2]
 
         expected_kwargs = {
             'binary_data': True
@@ -477,6 +1972,40 @@ class TestCommand(unittest.TestCase):
         eq_(result, self.expected)
         eq_(_show.call_args[0][0], self.expected)
 
+    @mock.patch.object(command, 'show')
+    @mock.patch.object(MockTastypieResource, '_call_request')
+    def test_some_binary_data_file(self, _call_request, _show):
+        _call_request.return_value = mock_response(self.method, self.url)
+        with tempfile.NamedTemporaryFile() as upload:
+            upload.write('FOOBAR')
+            upload.flush()
+            command.new(self.setup_config(binary_data='@' + upload.name),
+                        lib_api=self.api)
+        body = _call_request.call_args[0][2]
+        eq_(body.name, upload.name)
+        ok_(body.closed)
+
+    def test_stdin_body_file(self):
+        with tempfile.TemporaryFile() as upload:
+            upload.write('x' * 100)
+            upload.seek(0)
+            with mock.patch.object(command.sys, 'stdin', upload):
+                body = command.stdin_body()
+                ok_(body is upload)
+                prepared = requests.Request(
+                    'POST', 'http://foo.com/', data=body).prepare()
+        eq_(prepared.headers['Content-Length'], '100')
+
+    def test_stdin_body_pipe(self):
+        read, write = os.pipe()
+        try:
+            with os.fdopen(read, 'rb') as stdin:
+                with mock.patch.object(command.sys, 'stdin', stdin):
+                    body = command.stdin_body()
+            ok_(not isinstance(body, file))
+        finally:
+            os.close(write)
+
     def test_invalid_data(self):
         self._test_new_invalid(data='{"foo":')
 
@@ -493,3 +2022,99 @@ class TestCommand(unittest.TestCase):
     def test_show_list(self):
         self.url = '/unformatted/settings/'
         self._test_new_valid()
+
+
+def batch_response(method, url, data, params, headers, **kw):
+    if url.endswith('/missing/'):
+        return json_response(404, {'error': 'missing'})
+    if url.endswith('/html/'):
+        return transport.build_response(
+            method, 'http://foo.com' + url, 502, '<html>Bad Gateway</html>',
+            headers={'content-type': 'application/json'})
+    if url.endswith('/slow/'):
+        time.sleep(0.05)
+    return json_response(200, {'method': method, 'url': url, 'data': data})
+
+
+@mock.patch.object(MockTastypieResource, '_call_request',
+                   side_effect=batch_response)
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.api = MockAPI('')
+
+    def batch(self, lines, unordered=False, concurrency=4):
+        config = mock.Mock(batch='-', concurrency=concurrency,
+                           unordered=unordered)
+        output = StringIO()
+        with mock.patch.object(command.sys, 'stdin',
+                               StringIO('\n'.join(lines))):
+            failed = command.batch(config, lib_api=self.api, output=output)
+        return failed, [json.loads(l) for l in output.getvalue().splitlines()]
+
+    def test_ordered(self, _call_request):
+        failed, results = self.batch([
+            json.dumps({'url': 'http://foo.com/a/slow/'}),
+            json.dumps({'method': 'post', 'url': 'http://foo.com/a/b/',
+                        'data': {'foo': 'bar'}}),
+            '',
+            json.dumps({'url': 'http://foo.com/a/missing/'}),
+            '{"url":',
+        ])
+        eq_(failed, 2)
+        eq_([r['line'] for r in results], [1, 2, 4, 5])
+        eq_(results[0]['body']['url'], '/a/slow/')
+        eq_(results[1]['method'], 'POST')
+        eq_(json.loads(results[1]['body']['data']), {'foo': 'bar'})
+        eq_(results[2]['status'], 404)
+        eq_(results[2]['body'], {'error': 'missing'})
+        ok_(results[3]['error'].startswith('ValueError'))
+
+    def test_unordered(self, _call_request):
+        failed, results = self.batch([
+            json.dumps({'url': 'http://foo.com/a/slow/'}),
+            json.dumps({'url': 'http://foo.com/a/b/'})], unordered=True)
+        eq_(failed, 0)
+        eq_([r['line'] for r in results], [2, 1])
+
+    def test_delete(self, _call_request):
+        failed, results = self.batch([json.dumps(
+            {'method': 'DELETE', 'url': 'http://foo.com/a/b/?x=1'})])
+        eq_(results[0]['body'], True)
+        eq_(_call_request.call_args[0][:4], ('DELETE', '/a/b/', None,
+                                             {'x': '1'}))
+
+    def test_not_json(self, _call_request):
+        failed, results = self.batch([
+            json.dumps({'url': 'http://foo.com/a/html/'}),
+            json.dumps({'url': 'http://foo.com/a/b/'})])
+        eq_(failed, 1)
+        eq_(results[0]['status'], 502)
+        eq_(results[0]['body'], '<html>Bad Gateway</html>')
+        ok_(results[1]['ok'])
+
+    def test_not_encodable(self, _call_request):
+        _call_request.side_effect = None
+        _call_request.return_value = json_response(200, {})
+        with mock.patch.object(MockTastypieResource, 'get',
+                               return_value=object()):
+            failed, results = self.batch([
+                json.dumps({'url': 'http://foo.com/a/b/'})])
+        eq_(failed, 0)
+        ok_(results[0]['body'].startswith('<object object'))
+
+    def test_slices(self, _call_request):
+        lines = [json.dumps({'url': 'http://foo.com/a/%s/' % i})
+                 for i in range(10)]
+        with mock.patch.object(command, 'BATCH_SLICE', 1):
+            failed, results = self.batch(lines, concurrency=3)
+        eq_(failed, 0)
+        eq_([r['line'] for r in results], range(1, 11))
+
+    def test_shared_api(self, _call_request):
+        apis = command.APIs(4)
+        url = urlparse.urlparse('http://foo.com/a/')
+        api = apis.get(url)
+        ok_(apis.get(urlparse.urlparse('http://foo.com/b/')) is api)
+        ok_(apis.get(urlparse.urlparse('http://bar.com/a/')) is not api)
+        eq_(api._store['adapter']._pool_maxsize, 4)
@@ -0,0 +1,346 @@
+"""
+Transports send the requests of an API. By default an API sends them with
+its requests session, pass a transport to the API to send them another way:
+
+    from curling.transport import WSGITransport
+
+    api = API('http://localhost', transport=WSGITransport(application))
+
+Every transport returns a requests Response and raises requests
+ConnectionError or Timeout, so the rest of curling works the same.
+"""
+import datetime
+import json
+import logging
+import sys
+import threading
+import time
+import urllib
+import urlparse
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.core.handlers.wsgi import WSGIRequest
+from django.http import (Http404, HttpResponseForbidden, HttpResponseNotFound,
+                         HttpResponseServerError)
+
+import requests
+from requests.exceptions import ConnectionError, Timeout
+from requests.packages import urllib3
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+try:
+    from django.urls import resolve
+except ImportError:
+    from django.core.urlresolvers import resolve
+
+
+def build_response(method, url, status_code, content, headers=None,
+                   reason=None, elapsed=None):
+    """Makes a requests Response for a response that didn't come from one."""
+    resp = requests.models.Response()
+    resp.status_code = status_code
+    resp.reason = reason
+    resp.headers = CaseInsensitiveDict(headers or {})
+    resp.encoding = get_encoding_from_headers(resp.headers)
+    resp._content = content
+    # So iter_content reads the content rather than raw.
+    resp._content_consumed = content is not False
+    resp.url = url
+    resp.elapsed = elapsed or datetime.timedelta(0)
+    resp.request = requests.Request(method, url).prepare()
+    return resp
+
+
+def add_params(url, params):
+    """Adds the query string params to the url."""
+    if not params:
+        return url
+    query = urllib.urlencode(params, doseq=True)
+    return '%s%s%s' % (url, '&' if '?' in url else '?', query)
+
+
+def _body(data):
+    if data is None:
+        return ''
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    if isinstance(data, str):
+        return data
+    if hasattr(data, 'read'):
+        return data.read()
+    return ''.join(data)
+
+
+def wsgi_environ(method, url, body, headers):
+    """The WSGI environ of a request for the url."""
+    parts = urlparse.urlsplit(url)
+    https = parts.scheme == 'https'
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': urllib.unquote(parts.path) or '/',
+        'QUERY_STRING': parts.query,
+        'SERVER_NAME': parts.hostname or 'localhost',
+        'SERVER_PORT': str(parts.port or (443 if https else 80)),
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': parts.scheme or 'http',
+        'wsgi.input': StringIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for key, value in (headers or {}).items():
+        key = key.upper().replace('-', '_')
+        if key == 'CONTENT_TYPE':
+            environ[key] = value
+        elif key != 'CONTENT_LENGTH':
+            environ['HTTP_%s' % key] = value
+    return environ
+
+
+class Transport(object):
+    """
+    Sends a request, taking the same arguments as requests.Session.request
+    does and returning a requests Response.
+    """
+
+    def request(self, method, url, data=None, params=None, headers=None,
+                **kw):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SessionTransport(Transport):
+    """Sends requests with a requests session, like an API does anyway."""
+
+    def __init__(self, session=None):
+        self.session = session or requests.Session()
+
+    def request(self, method, url, data=None, params=None, headers=None,
+                **kw):
+        return self.session.request(method, url, data=data, params=params,
+                                    headers=headers, **kw)
+
+    def close(self):
+        self.session.close()
+
+
+class Urllib3Transport(Transport):
+    """
+    Sends requests straight to a urllib3 PoolManager, skipping the adapters
+    and hooks of requests. The keyword arguments are passed to the
+    PoolManager, e.g. maxsize.
+    """
+
+    def __init__(self, pool_manager=None, max_redirects=30, **kw):
+        self.pool = pool_manager or urllib3.PoolManager(**kw)
+        self.max_redirects = max_redirects
+
+    def _timeout(self, timeout):
+        if timeout is None:
+            return urllib3.Timeout.DEFAULT_TIMEOUT
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return urllib3.Timeout(connect=connect, read=read)
+        return urllib3.Timeout(connect=timeout, read=timeout)
+
+    def request(self, method, url, data=None, params=None, headers=None,
+                timeout=None, stream=False, **kw):
+        url = add_params(url, params)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        # Iterators have no length, so they are sent chunked.
+        chunked = not (data is None or isinstance(data, str) or
+                       hasattr(data, 'read'))
+        retries = urllib3.Retry(total=None, connect=0, read=0, status=0,
+                                redirect=self.max_redirects,
+                                raise_on_redirect=False)
+        start = time.time()
+        try:
+            raw = self.pool.urlopen(method, url, body=data, headers=headers,
+                                    timeout=self._timeout(timeout),
+                                    retries=retries, chunked=chunked,
+                                    preload_content=not stream)
+        except urllib3.exceptions.MaxRetryError, e:
+            if isinstance(e.reason, urllib3.exceptions.TimeoutError):
+                raise Timeout(e)
+            raise ConnectionError(e)
+        except urllib3.exceptions.TimeoutError, e:
+            raise Timeout(e)
+        except urllib3.exceptions.HTTPError, e:
+            raise ConnectionError(e)
+        elapsed = datetime.timedelta(seconds=time.time() - start)
+        resp = build_response(method, url, raw.status,
+                              False if stream else raw.data,
+                              headers=raw.headers, reason=raw.reason,
+                              elapsed=elapsed)
+        resp.raw = raw
+        return resp
+
+    def close(self):
+        self.pool.clear()
+
+
+class WSGITransport(Transport):
+    """
+    Calls a WSGI application in process, without any sockets or HTTP. The
+    host and port of the API are passed to the application as SERVER_NAME
+    and SERVER_PORT.
+    """
+
+    def __init__(self, application, environ=None):
+        self.application = application
+        self.environ = environ or {}
+
+    def request(self, method, url, data=None, params=None, headers=None,
+                **kw):
+        url = add_params(url, params)
+        environ = wsgi_environ(method, url, _body(data), headers)
+        environ.update(self.environ)
+        started = []
+        written = []
+
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info and written:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            started[:] = [status, response_headers]
+            return written.append
+
+        start = time.time()
+        result = self.application(environ, start_response)
+        try:
+            content = ''.join(written) + ''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        status, response_headers = started
+        code, _, reason = status.partition(' ')
+        return build_response(
+            method, url, int(code), content, headers=response_headers,
+            reason=reason,
+            elapsed=datetime.timedelta(seconds=time.time() - start))
+
+
+class DjangoTransport(Transport):
+    """
+    Calls the views of the Django project this runs in directly, such as
+    Tastypie resources: the URL is resolved with the URL resolver, by
+    default the ROOT_URLCONF, and the view called with a request made for
+    it. There is no HTTP and the middleware isn't run.
+
+    As in Django, a view raising Http404 or PermissionDenied gives a 404 or
+    403 response and any other exception a 500 response, unless the setting
+    DEBUG_PROPAGATE_EXCEPTIONS is True.
+    """
+
+    def __init__(self, urlconf=None):
+        self.urlconf = urlconf
+
+    def _call_view(self, request):
+        try:
+            match = resolve(request.path_info, urlconf=self.urlconf)
+            return match.func(request, *match.args, **match.kwargs)
+        except Http404:
+            return HttpResponseNotFound()
+        except PermissionDenied:
+            return HttpResponseForbidden()
+        except Exception:
+            if settings.DEBUG_PROPAGATE_EXCEPTIONS:
+                raise
+            logging.getLogger('django.request').error(
+                'Internal Server Error: %s', request.path,
+                exc_info=sys.exc_info(), extra={'request': request})
+            return HttpResponseServerError()
+
+    def request(self, method, url, data=None, params=None, headers=None,
+                **kw):
+        url = add_params(url, params)
+        request = WSGIRequest(wsgi_environ(method, url, _body(data), headers))
+        start = time.time()
+        response = self._call_view(request)
+        try:
+            if getattr(response, 'streaming', False):
+                content = ''.join(response.streaming_content)
+            else:
+                content = response.content
+        finally:
+            response.close()
+        return build_response(
+            method, url, response.status_code, content,
+            headers=response.items(), reason=response.reason_phrase,
+            elapsed=datetime.timedelta(seconds=time.time() - start))
+
+
+class NoRecordedResponse(LookupError):
+    pass
+
+
+class RecordedTransport(Transport):
+    """
+    Replays recorded responses, keyed on the method and URL, including the
+    query string. Add responses with add, or load them from a file written
+    by dump.
+
+    If a transport is passed, requests that don't have a recorded response
+    are sent with it and their responses recorded, otherwise they raise
+    NoRecordedResponse.
+    """
+
+    def __init__(self, responses=None, transport=None):
+        self.responses = dict(responses or {})
+        self.transport = transport
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _key(self, method, url):
+        return '%s %s' % (method.upper(), url)
+
+    def add(self, method, url, status_code=200, content='', headers=None):
+        if not isinstance(content, basestring):
+            content = json.dumps(content)
+            headers = dict({'content-type': 'application/json'},
+                           **(headers or {}))
+        self.responses[self._key(method, url)] = {
+            'status_code': status_code,
+            'content': content,
+            'headers': dict(headers or {}),
+        }
+
+    def request(self, method, url, data=None, params=None, headers=None,
+                **kw):
+        url = add_params(url, params)
+        with self._lock:
+            self.calls.append((method, url, data, headers))
+        recorded = self.responses.get(self._key(method, url))
+        if recorded is not None:
+            return build_response(method, url, recorded['status_code'],
+                                  recorded['content'], recorded['headers'])
+        if self.transport is None:
+            raise NoRecordedResponse(self._key(method, url))
+        resp = self.transport.request(method, url, data=data,
+                                      headers=headers, **kw)
+        # The content is stored decoded.
+        hdrs = dict((k, v) for k, v in resp.headers.items()
+                    if k.lower() not in ('content-encoding', 'content-length',
+                                         'transfer-encoding'))
+        self.add(method, url, resp.status_code, resp.content, hdrs)
+        return resp
+
+    def dump(self, fileobj):
+        json.dump(self.responses, fileobj, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, fileobj, transport=None):
+        return cls(json.load(fileobj), transport=transport)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()